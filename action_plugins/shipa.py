@@ -0,0 +1,174 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+name: shipa
+
+short_description: Run shipa modules inside the controller process
+
+version_added: "0.0.1"
+
+description:
+    - Action plugin behind every shipa_* module, the per-module files are symlinks to this one.
+    - When the task runs on the local connection (e.g. delegate_to localhost) the module is imported and run
+      in the controller worker process, skipping the AnsiballZ payload and the new Python interpreter.
+    - Ansible forks a new worker process for every task, so nothing kept in memory outlives the task,
+      neither the imported modules nor the keep-alive connection pool. Connections are reused within a task,
+      across tasks only the on-disk caches, e.g. the auth probe, are shared.
+    - Tasks on other connections, with the shipa_run_on_controller variable set to false, or on an
+      ansible-core whose AnsibleModule cannot be run in-process (checked once per worker), run the module as usual.
+'''
+
+import os
+import sys
+import json
+import types
+import traceback
+import importlib.util
+
+from ansible.module_utils import basic
+from ansible.module_utils.basic import AnsibleModule, remove_values
+from ansible.module_utils.common.warnings import get_deprecation_messages, get_warning_messages
+from ansible.module_utils.common.text.converters import to_bytes
+from ansible.plugins.action import ActionBase
+from ansible.utils.display import Display
+
+display = Display()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules already imported by this worker process, name -> python module
+_MODULES = {}
+
+# whether AnsibleModule can be run in this process, None until probed
+_IN_PROCESS = None
+
+# serialization profile ansible-core 2.19 and later decode module arguments with, set by AnsiballZ otherwise
+SERIALIZATION_PROFILE = 'legacy'
+
+
+def load_module_utils(names=('shipa_client', 'shipa_reconcile')):
+    """ module_utils are not importable by controller plugins, load the shipa ones next to this directory """
+    for util in names:
+        name = 'ansible.module_utils.{}'.format(util)
+        if name not in sys.modules:
+            path = os.path.join(ROOT, 'module_utils', '{}.py'.format(util))
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules[name] = module
+
+
+class ModuleExit(Exception):
+    def __init__(self, result):
+        super(ModuleExit, self).__init__()
+        self.result = result
+
+
+class ControllerAnsibleModule(AnsibleModule):
+    """ AnsibleModule that hands its result back to the action plugin instead of printing it and exiting """
+
+    def exit_json(self, **kwargs):
+        kwargs.setdefault('changed', False)
+        raise ModuleExit(self._result(kwargs))
+
+    def fail_json(self, msg, **kwargs):
+        kwargs['failed'] = True
+        kwargs['msg'] = msg
+        raise ModuleExit(self._result(kwargs))
+
+    def _result(self, kwargs):
+        """ The result _return_formatted would print, with the warnings and deprecations of the run """
+        if 'warnings' in kwargs:
+            warnings = kwargs['warnings']
+            for warning in warnings if isinstance(warnings, list) else [warnings]:
+                self.warn(warning)
+        warnings = get_warning_messages()
+        if warnings:
+            kwargs['warnings'] = list(warnings)
+        deprecations = get_deprecation_messages()
+        if deprecations:
+            kwargs['deprecations'] = list(deprecations)
+        return remove_values(kwargs, self.no_log_values)
+
+
+def load_module(name, path):
+    module = _MODULES.get(name)
+    if module is None:
+        load_module_utils()
+        spec = importlib.util.spec_from_file_location('ansible_shipa_{}'.format(name), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.AnsibleModule = ControllerAnsibleModule
+        _MODULES[name] = module
+    return module
+
+
+def run_module(module, args):
+    previous_args = basic._ANSIBLE_ARGS
+    previous_profile = getattr(basic, '_ANSIBLE_PROFILE', None)
+    basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': args}))
+    if hasattr(basic, '_ANSIBLE_PROFILE'):
+        basic._ANSIBLE_PROFILE = SERIALIZATION_PROFILE
+    try:
+        module.run_module()
+    except ModuleExit as e:
+        return e.result
+    except Exception as e:
+        return dict(failed=True, msg='shipa module failed: {}'.format(e), exception=traceback.format_exc())
+    finally:
+        basic._ANSIBLE_ARGS = previous_args
+        if hasattr(basic, '_ANSIBLE_PROFILE'):
+            basic._ANSIBLE_PROFILE = previous_profile
+    return dict(failed=True, msg='shipa module returned without a result')
+
+
+def _probe():
+    module = ControllerAnsibleModule(argument_spec=dict(probe=dict(type='str')))
+    module.exit_json(probe=module.params['probe'])
+
+
+def in_process_supported():
+    """
+    Whether modules can run in this process.
+
+    AnsibleModule reads its arguments from globals that AnsiballZ sets, run_module sets them too, including
+    the serialization profile of ansible-core 2.19. They are not a public API, so a trivial module is run once
+    to check the arguments still reach it on this ansible-core.
+    """
+    global _IN_PROCESS
+    if _IN_PROCESS is None:
+        try:
+            result = run_module(types.SimpleNamespace(run_module=_probe), {'probe': 'ok'})
+        except Exception as e:
+            result = dict(failed=True, msg=str(e))
+        _IN_PROCESS = not result.get('failed') and result.get('probe') == 'ok'
+        if not _IN_PROCESS:
+            display.vvv('shipa: modules cannot run in-process on this ansible-core, running them as usual: {}'.format(
+                result.get('msg')))
+    return _IN_PROCESS
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+        task_vars = task_vars or {}
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        on_controller = (self._connection.transport == 'local' and task_vars.get('shipa_run_on_controller', True)
+                         and in_process_supported())
+        path = self._shared_loader_obj.module_loader.find_plugin(self._task.action) if on_controller else None
+        if not path:
+            result.update(self._execute_module(task_vars=task_vars))
+            return result
+
+        args = dict(self._task.args)
+        args['_ansible_check_mode'] = self._play_context.check_mode
+        args['_ansible_diff'] = self._play_context.diff
+        args['_ansible_no_log'] = self._play_context.no_log
+
+        result.update(run_module(load_module(self._task.action, path), args))
+        return result
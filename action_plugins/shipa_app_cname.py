@@ -0,0 +1 @@
+shipa.py
\ No newline at end of file
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Count TCP/TLS handshakes made by a typical module run against a local HTTPS stub.
+
+A module run does an auth probe, a GET, a PUT and a re-GET. The benchmark replays that sequence
+with a new connection per request (what fetch_url does) and with shipa_client.ConnectionPool.
+
+    python benchmarks/keepalive.py --runs 50
+
+Requires ansible and the openssl binary (used to create a throwaway self-signed certificate).
+"""
+
+import os
+import ssl
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from ansible.module_utils.urls import open_url
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_shipa_client():
+    spec = importlib.util.spec_from_file_location('shipa_client', os.path.join(ROOT, 'module_utils', 'shipa_client.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one segment once the handler is done (wfile is flushed after every request),
+    # separate small writes stall every reused connection on the client's delayed ACK
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # one handler instance per accepted connection
+        self.server.handshakes += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        body = json.dumps({'name': 'bench-app', 'pool': 'bench'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    handshakes = 0
+
+
+def self_signed_cert(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def start_stub(cert, key):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def module_run(request, host):
+    request('GET', '{}/plans'.format(host))
+    request('GET', '{}/apps/bench-app'.format(host))
+    request('PUT', '{}/apps/bench-app'.format(host), b'{"pool": "bench"}')
+    request('GET', '{}/apps/bench-app'.format(host))
+
+
+def bench(name, server, runs, make_request, host):
+    server.handshakes = 0
+    started = time.time()
+    for _ in range(runs):
+        module_run(make_request(), host)
+    elapsed = time.time() - started
+    print('{:<12} requests={:<6} handshakes={:<6} wall={:.3f}s'.format(name, runs * 4, server.handshakes, elapsed))
+    return server.handshakes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=50, help='module runs to simulate')
+    args = parser.parse_args()
+
+    shipa_client = load_shipa_client()
+    directory = tempfile.mkdtemp()
+    try:
+        server = start_stub(*self_signed_cert(directory))
+        host = 'https://127.0.0.1:{}'.format(server.server_address[1])
+        headers = {'Content-Type': 'application/json'}
+
+        def per_request():
+            def request(method, url, data=None):
+                open_url(url, data=data, headers=headers, method=method, validate_certs=False).read()
+            return request
+
+        def pooled():
+            pool = shipa_client.ConnectionPool(validate_certs=False)
+
+            def request(method, url, data=None):
+                pool.request(method, url, data, headers)
+            return request
+
+        baseline = bench('fetch_url', server, args.runs, per_request, host)
+        keepalive = bench('keep-alive', server, args.runs, pooled, host)
+        print('handshakes saved: {} ({:.0%})'.format(baseline - keepalive, 1 - float(keepalive) / baseline))
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
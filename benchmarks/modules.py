@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Requests, wall time and memory of every library/shipa_* module against the local API stub.
+
+For each dataset size a stub (benchmarks/stub.py) is started in a separate process, then every module
+runs a typical task in this process through the controller action plugin. A task gets a fresh
+shipa_cache_dir, so it includes the auth probe, and a fresh connection pool: on the controller Ansible forks
+a worker per task, connections are only kept alive between the requests of a task.
+Tasks run repeatedly, after the first run they find their resources in place.
+Reported per module and size:
+
+    requests   API calls made by one task, as counted by the stub
+    conns      TCP connections opened by one task
+    wall       median wall time of --runs tasks
+    peak       peak memory allocated by one task (tracemalloc, measured on an extra run)
+
+    python benchmarks/modules.py --sizes 10 1000 100000 --latency 0.005 --runs 5
+
+Requires an ansible-core the action plugin can run modules in-process on, 2.19 included.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import importlib.util
+
+from ansible.module_utils.urls import open_url
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one typical task per module, resources named <kind>-0 exist in the stub, <kind>-new do not
+TASKS = (
+    ('shipa_framework', dict(
+        name='framework-0',
+        resources={'general': {'setup': {'provisioner': 'kubernetes'}, 'plan': {'name': 'shipa-plan'}}},
+    )),
+    ('shipa_cluster', dict(
+        name='cluster-0',
+        endpoint={'addresses': ['https://10.0.0.2']},
+        resources={'frameworks': [{'name': 'framework-0'}]},
+    )),
+    ('shipa_application', dict(
+        name='app-new', teamowner='shipa-team', framework='framework-0', plan='shipa-plan', tags=['bench'],
+    )),
+    ('shipa_app_env', dict(
+        app='app-0', envs=[{'name': 'BENCH', 'value': '1'}], norestart=True,
+    )),
+    ('shipa_app_cname', dict(
+        app='app-0', cname='bench.example.com', encrypt=False,
+    )),
+    ('shipa_network_policy', dict(
+        app='app-0', ingress={'policy_mode': 'allow-all'}, egress={'policy_mode': 'deny-all'},
+    )),
+    ('shipa_app_deploy', dict(
+        app='app-0', image='docker.io/shipasoftware/go-app:v1', port={'number': 8000}, force=True,
+    )),
+    ('shipa_job', dict(
+        name='job-new', framework='framework-0', team='shipa-team',
+        containers=[{'name': 'main', 'image': 'busybox'}], policy={'restartPolicy': 'Never'},
+    )),
+    ('shipa_state', dict(
+        state={
+            'apps': [{
+                'name': 'app-1', 'framework': 'framework-0', 'teamowner': 'shipa-team', 'plan': 'shipa-plan',
+                'tags': ['bench'],
+                'env': {'envs': [{'name': 'BENCH', 'value': '1'}]},
+                'cname': {'cnames': [{'cname': 'state.example.com'}]},
+            }],
+        },
+    )),
+)
+
+
+def load_action_plugin():
+    spec = importlib.util.spec_from_file_location('shipa_action', os.path.join(ROOT, 'action_plugins', 'shipa.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def start_stub(size, latency):
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'benchmarks', 'stub.py'),
+         '--port', '0', '--size', str(size), '--latency', str(latency)],
+        stdout=subprocess.PIPE, universal_newlines=True,
+    )
+    return stub, stub.stdout.readline().strip()
+
+
+def stub_call(host, method, path):
+    return json.loads(open_url('{}/_stub/{}'.format(host, path), method=method).read() or '{}')
+
+
+def reset_pools():
+    """ Drop the process-wide connection pools, as a task starting in a new worker process would """
+    pools = sys.modules['ansible.module_utils.shipa_client'].ConnectionPool._shared
+    for pool in pools.values():
+        pool.close()
+    pools.clear()
+
+
+def run_task(action, name, args, host, trace_memory=False):
+    cache_dir = tempfile.mkdtemp()
+    args = dict(args, shipa_host=host, shipa_token='bench', shipa_cache_dir=cache_dir)
+    module = action.load_module(name, os.path.join(ROOT, 'library', '{}.py'.format(name)))
+    stub_call(host, 'POST', 'reset')
+    reset_pools()
+    try:
+        if trace_memory:
+            tracemalloc.start()
+        started = time.time()
+        result = action.run_module(module, args)
+        elapsed = time.time() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        shutil.rmtree(cache_dir)
+
+    if result.get('failed'):
+        raise RuntimeError('{} failed: {}'.format(name, result.get('msg')))
+    return elapsed, peak, stub_call(host, 'GET', 'stats')
+
+
+def bench(action, size, latency, runs, modules):
+    stub, host = start_stub(size, latency)
+    try:
+        for name, args in TASKS:
+            if modules and name not in modules:
+                continue
+            walls = []
+            for _ in range(runs):
+                elapsed, _, stats = run_task(action, name, args, host)
+                walls.append(elapsed)
+            _, peak, _ = run_task(action, name, args, host, trace_memory=True)
+            print('{:<22} {:>7} {:>9} {:>6} {:>10.1f} {:>10.1f}'.format(
+                # the stats call itself opened one of the connections
+                name, size, stats['requests'], stats['connections'] - 1,
+                statistics.median(walls) * 1000, peak / 1024.0,
+            ))
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000], help='resources per collection')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stub adds to every request')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per module and size')
+    parser.add_argument('--module', action='append', help='only benchmark these modules')
+    args = parser.parse_args()
+
+    action = load_action_plugin()
+    if not action.in_process_supported():
+        # tasks are timed in this process, running them through AnsiballZ would measure something else
+        parser.exit(1, 'shipa modules cannot run in-process on this ansible-core, see action_plugins/shipa.py\n')
+    print('{:<22} {:>7} {:>9} {:>6} {:>10} {:>10}'.format('module', 'size', 'requests', 'conns', 'wall ms', 'peak KiB'))
+    for size in args.sizes:
+        bench(action, size, args.latency, args.runs, args.module)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
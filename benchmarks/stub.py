@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Shipa API endpoints targeted by shipa_client.Endpoint.
+
+Serves plans, pools-config, apps (with their deploy, cname, env and network-policy routes), deploys,
+provisioner/clusters and jobs over plain HTTP with keep-alive. Each collection holds `--size` generated
+resources (app-0, framework-0, cluster-0, job-0, ...), only resources written by clients are stored,
+so a 100k dataset costs nothing until it is listed. Every request is delayed by `--latency` seconds.
+
+    python benchmarks/stub.py --port 8080 --size 1000 --latency 0.01
+
+Any bearer token is accepted, requests without one get a 401. Admin routes help benchmarks and tests:
+GET /_stub/stats returns request counts per endpoint, POST /_stub/reset clears them and the pending faults,
+POST /_stub/faults queues faults for the next API requests, one per request, a JSON list of:
+
+    {"status": 503, "headers": {"Retry-After": "1"}}   reply with this status instead
+    {"drop": true}                                     close the connection without replying
+    {"close": true}                                    reply, then close the kept-alive connection
+"""
+
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+PLAN = {'name': 'shipa-plan', 'memory': 0, 'swap': 0, 'cpushare': 100, 'default': True}
+
+
+def framework(name):
+    return {
+        'shipaFramework': name,
+        'name': name,
+        'resources': {
+            'general': {
+                'setup': {'provisioner': 'kubernetes'},
+                'plan': {'name': PLAN['name']},
+                'access': {'append': ['shipa-team']},
+            },
+        },
+    }
+
+
+def application(name):
+    return {
+        'name': name,
+        'pool': 'framework-0',
+        'teamowner': 'shipa-team',
+        'plan': {'name': PLAN['name']},
+        'tags': ['bench'],
+        'cname': [],
+        'platform': 'static',
+        'units': [],
+    }
+
+
+def cluster(name):
+    return {
+        'name': name,
+        'endpoint': {'addresses': ['https://10.0.0.1']},
+        'resources': {'frameworks': [{'name': 'framework-0'}]},
+    }
+
+
+def job(name):
+    return {
+        'name': name,
+        'framework': 'framework-0',
+        'team': 'shipa-team',
+        'containers': [{'name': 'main', 'image': 'busybox', 'command': ['true']}],
+        'policy': {'restartPolicy': 'Never'},
+    }
+
+
+class Collection:
+    """ `size` generated resources named <prefix>-<i>, plus the ones written by clients """
+
+    def __init__(self, prefix, size, make):
+        self.prefix = prefix
+        self.size = size
+        self.make = make
+        self.written = {}
+        self.lock = threading.Lock()
+        self._listing = None
+
+    def get(self, name):
+        resource = self.written.get(name)
+        if resource is None and self._generated(name):
+            resource = self.make(name)
+        return resource
+
+    def put(self, name, resource):
+        with self.lock:
+            self.written[name] = resource
+            self._listing = None
+
+    def listing(self, offset=0, limit=None):
+        """ Serialized list, the full one is cached until the next write """
+        if offset or limit:
+            names = ['{}-{}'.format(self.prefix, i) for i in range(self.size)]
+            names += [name for name in self.written if not self._generated(name)]
+            names = names[offset:offset + limit if limit else None]
+            return json.dumps([self.get(name) for name in names]).encode('utf-8')
+
+        with self.lock:
+            if self._listing is None:
+                generated = (self.get('{}-{}'.format(self.prefix, i)) for i in range(self.size))
+                extra = (resource for name, resource in self.written.items() if not self._generated(name))
+                items = ','.join(json.dumps(item) for item in itertools.chain(generated, extra))
+                self._listing = '[{}]'.format(items).encode('utf-8')
+            return self._listing
+
+    def _generated(self, name):
+        prefix, _, index = name.rpartition('-')
+        return prefix == self.prefix and index.isdigit() and int(index) < self.size
+
+
+class Dataset:
+    def __init__(self, size):
+        self.frameworks = Collection('framework', size, framework)
+        self.apps = Collection('app', size, application)
+        self.clusters = Collection('cluster', size, cluster)
+        self.jobs = Collection('job', size, job)
+        self.envs = {}
+        self.policies = {}
+        self.deploys = {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one segment once the handler is done (wfile is flushed after every request),
+    # separate small writes stall every reused connection on the client's delayed ACK
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        path = [part for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if path[:1] == ['_stub']:
+            return self._admin(method, path[1:], body)
+
+        server = self.server
+        server.count(method, path)
+        if server.latency:
+            time.sleep(server.latency)
+
+        fault = server.next_fault()
+        if fault.get('drop'):
+            self.close_connection = True
+            return
+        if fault.get('status'):
+            return self._reply(fault['status'], {'Error': 'injected fault'}, fault.get('headers'))
+        if fault.get('close'):
+            # without a Connection: close header, the client finds out when it reuses the connection
+            self.close_connection = True
+
+        if not (self.headers.get('Authorization') or '').startswith('Bearer '):
+            return self._reply(401, {'Error': 'unauthorized'})
+
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return self._reply(400, {'Error': 'invalid json'})
+
+        route = self._route(method, path)
+        if route is None:
+            return self._reply(404, b'404 page not found\n')
+        return route(path, query, payload)
+
+    def _route(self, method, path):
+        routes = {
+            ('GET', 'plans', 1): self._plans,
+            ('GET', 'pools-config', 1): self._list(lambda data: data.frameworks),
+            ('GET', 'pools-config', 2): self._get(lambda data: data.frameworks),
+            ('POST', 'pools-config', 1): self._write_framework,
+            ('PUT', 'pools-config', 1): self._write_framework,
+            ('GET', 'apps', 1): self._list(lambda data: data.apps),
+            ('GET', 'apps', 2): self._get(lambda data: data.apps),
+            ('POST', 'apps', 1): self._write_app,
+            ('PUT', 'apps', 2): self._write_app,
+            ('GET', 'deploys', 1): self._list_deploys,
+            ('GET', 'provisioner', 2): self._list(lambda data: data.clusters),
+            ('GET', 'provisioner', 3): self._get(lambda data: data.clusters),
+            ('POST', 'provisioner', 2): self._write_cluster,
+            ('PUT', 'provisioner', 3): self._write_cluster,
+            ('GET', 'jobs', 1): self._list(lambda data: data.jobs),
+            ('GET', 'jobs', 2): self._get(lambda data: data.jobs),
+            ('POST', 'jobs', 1): self._write_job,
+        }
+        if path[:1] == ['apps'] and len(path) == 3:
+            if self.server.data.apps.get(path[1]) is None:
+                return lambda *args: self._reply(404, {'Error': 'App {} not found.'.format(path[1])})
+            return {
+                ('POST', 'deploy'): self._deploy,
+                ('GET', 'env'): self._get_env,
+                ('POST', 'env'): self._set_env,
+                ('DELETE', 'env'): self._unset_env,
+                ('POST', 'cname'): self._add_cname,
+                ('DELETE', 'cname'): self._remove_cname,
+                ('GET', 'network-policy'): self._get_policy,
+                ('PUT', 'network-policy'): self._set_policy,
+            }.get((method, path[2]))
+        if path[:2] == ['provisioner', 'clusters'] or path[:1] != ['provisioner']:
+            return routes.get((method, path[0] if path else '', len(path)))
+        return None
+
+    def _plans(self, path, query, payload):
+        self._reply(200, [PLAN])
+
+    def _list(self, collection):
+        def handler(path, query, payload):
+            offset = int((query.get('offset') or [0])[0])
+            limit = int((query.get('limit') or [0])[0])
+            self._reply(200, collection(self.server.data).listing(offset, limit))
+        return handler
+
+    def _get(self, collection):
+        def handler(path, query, payload):
+            resource = collection(self.server.data).get(path[-1])
+            if resource is None:
+                return self._reply(404, {'Error': '{} not found'.format(path[-1])})
+            self._reply(200, resource)
+        return handler
+
+    def _write_framework(self, path, query, payload):
+        name = payload.get('shipaFramework')
+        resource = dict(framework(name), resources=payload.get('resources'))
+        self.server.data.frameworks.put(name, resource)
+        self._reply(201 if self.command == 'POST' else 200, resource)
+
+    def _write_app(self, path, query, payload):
+        apps = self.server.data.apps
+        name = path[1] if len(path) > 1 else payload.get('name')
+        resource = dict(apps.get(name) or application(name))
+        resource.update(
+            pool=payload.get('pool') or resource['pool'],
+            teamowner=payload.get('teamOwner') or resource['teamowner'],
+            plan={'name': payload.get('plan') or resource['plan']['name']},
+            tags=payload.get('tags') or resource['tags'],
+        )
+        apps.put(name, resource)
+        self._reply(201 if self.command == 'POST' else 200, resource)
+
+    def _write_cluster(self, path, query, payload):
+        name = path[2] if len(path) > 2 else payload.get('name')
+        resource = dict(cluster(name), endpoint=payload.get('endpoint'), resources=payload.get('resources'))
+        self.server.data.clusters.put(name, resource)
+        self._reply(201 if self.command == 'POST' else 200, resource)
+
+    def _write_job(self, path, query, payload):
+        self.server.data.jobs.put(payload.get('name'), payload)
+        self._reply(201, payload)
+
+    def _deploy(self, path, query, payload):
+        app = path[1]
+        deploys = self.server.data.deploys.setdefault(app, [])
+        deploys.insert(0, {'id': str(len(deploys) + 1), 'app': app, 'image': payload.get('image'),
+                           'status': 'success', 'duration': 1})
+        lines = [{'Message': 'deploying {}'.format(payload.get('image'))}, {'Message': 'OK'}]
+        self._reply(200, ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8'))
+
+    def _list_deploys(self, path, query, payload):
+        deploys = self.server.data.deploys.get((query.get('app') or [''])[0], [])
+        limit = int((query.get('limit') or [0])[0])
+        self._reply(200, deploys[:limit] if limit else deploys)
+
+    def _get_env(self, path, query, payload):
+        envs = self.server.data.envs.get(path[1], {})
+        # like the API, private values are masked
+        self._reply(200, [
+            dict(name=name, value=value if public else '*** (private variable)', public=public)
+            for name, (value, public) in sorted(envs.items())
+        ])
+
+    def _set_env(self, path, query, payload):
+        envs = self.server.data.envs.setdefault(path[1], {})
+        for env in payload.get('envs') or []:
+            envs[env.get('name')] = (env.get('value'), not payload.get('private'))
+        self._reply(200, {'Message': 'setting {} envs'.format(len(payload.get('envs') or []))})
+
+    def _unset_env(self, path, query, payload):
+        envs = self.server.data.envs.setdefault(path[1], {})
+        for name in query.get('env') or []:
+            envs.pop(name, None)
+        self._reply(200, {'Message': 'unsetting envs'})
+
+    def _add_cname(self, path, query, payload):
+        apps = self.server.data.apps
+        app = dict(apps.get(path[1]))
+        entry = '{}://{}'.format(payload.get('scheme') or 'http', payload.get('cname'))
+        app['cname'] = [cname for cname in app['cname'] if not cname.endswith('://' + payload.get('cname'))]
+        app['cname'].append(entry)
+        apps.put(path[1], app)
+        self._reply(200, {'Message': 'cname added'})
+
+    def _remove_cname(self, path, query, payload):
+        apps = self.server.data.apps
+        app = dict(apps.get(path[1]))
+        removed = set(query.get('cname') or [])
+        app['cname'] = [cname for cname in app['cname'] if cname.rpartition('://')[2] not in removed]
+        apps.put(path[1], app)
+        self._reply(200, {'Message': 'cname removed'})
+
+    def _get_policy(self, path, query, payload):
+        default = {'ingress': {'policy_mode': 'allow-all'}, 'egress': {'policy_mode': 'allow-all'}}
+        self._reply(200, self.server.data.policies.get(path[1], default))
+
+    def _set_policy(self, path, query, payload):
+        self.server.data.policies[path[1]] = dict(
+            ingress=payload.get('ingress') or {'policy_mode': 'allow-all'},
+            egress=payload.get('egress') or {'policy_mode': 'allow-all'},
+        )
+        self._reply(200, {'Message': 'network policy updated'})
+
+    def _admin(self, method, path, body):
+        if method == 'GET' and path == ['stats']:
+            return self._reply(200, self.server.stats())
+        if method == 'POST' and path == ['reset']:
+            self.server.reset()
+            return self._reply(200, {})
+        if method == 'POST' and path == ['faults']:
+            self.server.add_faults(json.loads(body or b'[]'))
+            return self._reply(200, {})
+        self._reply(404, b'404 page not found\n')
+
+    def _reply(self, status, body, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, size=10, latency=0.0):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.data = Dataset(size)
+        self.latency = latency
+        self.connections = 0
+        self.requests = Counter()
+        self.faults = []
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def count(self, method, path):
+        # group by endpoint, e.g. GET apps/{name}/env
+        template = list(path)
+        named = 2 if path[:1] == ['provisioner'] else 1
+        if len(template) > named:
+            template[named] = '{name}'
+        with self._lock:
+            self.requests['{} {}'.format(method, '/'.join(template))] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(requests=sum(self.requests.values()), connections=self.connections,
+                        endpoints=dict(self.requests))
+
+    def add_faults(self, faults):
+        with self._lock:
+            self.faults.extend(faults)
+
+    def next_fault(self):
+        with self._lock:
+            return self.faults.pop(0) if self.faults else {}
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.faults = []
+            self.connections = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, help='0 picks a free port')
+    parser.add_argument('--size', type=int, default=10, help='resources per collection')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), size=args.size, latency=args.latency)
+    # first line of output, benchmarks read the address from it
+    print('http://{}:{}'.format(*server.server_address), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
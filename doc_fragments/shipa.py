@@ -0,0 +1,104 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+    # Options shared by every shipa module, see shipa_client.shipa_argument_spec
+    DOCUMENTATION = r'''
+options:
+    shipa_host:
+        description: Shipa server host.
+        required: true
+        type: str
+    shipa_token:
+        description: Shipa API token.
+        required: true
+        type: str
+    shipa_auth_cache_ttl:
+        description:
+            - Seconds a successful auth probe (GET /plans) is remembered for the host/token pair.
+            - Set to 0 to probe on every task.
+        required: false
+        type: int
+        default: 300
+    shipa_lazy_auth:
+        description:
+            - Skip the auth probe, a 401 on the first real API call fails the task instead.
+        required: false
+        type: bool
+        default: false
+    shipa_cache_dir:
+        description:
+            - Directory for state shared between module runs on the same host.
+            - Defaults to C(~/.ansible/shipa), can be set with the SHIPA_CACHE_DIR environment variable.
+        required: false
+        type: path
+    shipa_keepalive:
+        description:
+            - Reuse one keep-alive connection per host for all API calls of the task.
+            - Requests going through an HTTP proxy always use a new connection.
+        required: false
+        type: bool
+        default: true
+    shipa_connect_timeout:
+        description: Seconds to wait for a connection to the Shipa API.
+        required: false
+        type: float
+        default: 10
+    shipa_read_timeout:
+        description:
+            - Seconds to wait for a response once connected.
+            - Deploys wait for their own, longer timeout.
+        required: false
+        type: float
+        default: 300
+    shipa_retries:
+        description:
+            - Times a failed request is retried, with jittered exponential backoff and honouring Retry-After.
+            - GET, PUT and DELETE are retried on connection errors and 429, 500, 502, 503 or 504 responses,
+              POST only on 429.
+        required: false
+        type: int
+        default: 3
+    shipa_circuit_threshold:
+        description:
+            - Consecutive failed requests after which calls to the host fail fast for 30 seconds,
+              shared by all module runs on the same machine. A request counts once, after its last retry.
+            - Set to 0 to disable.
+        required: false
+        type: int
+        default: 5
+    shipa_trace:
+        description:
+            - Return the API calls made by the task under shipa_trace, with method, endpoint template, status,
+              elapsed seconds, attempts, request and response bytes.
+        required: false
+        type: bool
+        default: false
+    shipa_trace_file:
+        description:
+            - JSONL file the trace entries are appended to, enables tracing.
+            - Can be set with the SHIPA_TRACE_FILE environment variable.
+        required: false
+        type: path
+    shipa_cassette:
+        description:
+            - JSONL file API requests are recorded to or replayed from, see shipa_cassette_mode.
+            - Tokens, certificates and passwords are redacted, the host is replaced by a placeholder.
+            - Can be set with the SHIPA_CASSETTE environment variable.
+        required: false
+        type: path
+    shipa_cassette_mode:
+        description:
+            - With record, requests are sent and appended to shipa_cassette.
+            - With replay, responses are served from shipa_cassette without network access, a task fails
+              when it sends a request that was not recorded or leaves recorded ones unsent.
+            - Can be set with the SHIPA_CASSETTE_MODE environment variable.
+            - Tasks are recorded and replayed in the order they run, record and replay with a single fork
+              (C(--forks 1)) so that the order is the same.
+        required: false
+        type: str
+        choices: ['record', 'replay']
+        default: replay
+'''
@@ -0,0 +1,178 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+name: shipa
+
+short_description: Shipa inventory source
+
+version_added: "0.0.1"
+
+description:
+    - Builds an inventory of Shipa applications, one host per application.
+    - Applications are grouped by framework, team and cluster. Frameworks, clusters and jobs are
+      available to every host as shipa_frameworks, shipa_clusters and shipa_jobs.
+    - Resources are fetched concurrently, with cache enabled they are kept by the inventory cache plugin
+      until cache_timeout expires so repeated plays start without hitting the API.
+    - Uses a YAML configuration file that ends with shipa.yml or shipa.yaml.
+
+extends_documentation_fragment:
+    - inventory_cache
+    - constructed
+
+options:
+    plugin:
+        description: Token that ensures this is a source file for the shipa plugin.
+        required: true
+        choices: ['shipa']
+    shipa_host:
+        description: Shipa server host.
+        required: true
+        type: str
+        env:
+            - name: SHIPA_HOST
+    shipa_token:
+        description: Shipa API token.
+        required: true
+        type: str
+        env:
+            - name: SHIPA_TOKEN
+    concurrency:
+        description: Number of resource lists fetched in parallel.
+        required: false
+        type: int
+        default: 4
+'''
+
+EXAMPLES = r'''
+# shipa.yml
+plugin: shipa
+shipa_host: https://target.shipa.cloud:8081
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.ansible/shipa/inventory
+cache_timeout: 600
+keyed_groups:
+    - key: shipa_app.plan.name
+      prefix: plan
+'''
+
+import os
+import sys
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+from ansible.errors import AnsibleParserError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
+
+
+def load_shipa_client():
+    """ module_utils are not importable by controller plugins, load shipa_client next to this directory """
+    name = 'ansible.module_utils.shipa_client'
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils', 'shipa_client.py')
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name]
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable, Constructable):
+    NAME = 'shipa'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('shipa.yml', 'shipa.yaml'))
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        use_cache = self.get_option('cache') and cache
+        update_cache = self.get_option('cache') and not cache
+
+        resources = None
+        if use_cache:
+            try:
+                resources = self._cache[cache_key]
+            except KeyError:
+                update_cache = True
+
+        if resources is None:
+            resources = self._fetch()
+
+        if update_cache:
+            self._cache[cache_key] = resources
+
+        self._populate(resources)
+
+    def _fetch(self):
+        shipa_client = load_shipa_client()
+        module = shipa_client.ControllerModule()
+        shipa = shipa_client.Client(module, self.get_option('shipa_host'), self.get_option('shipa_token'))
+
+        listings = (
+            ('apps', shipa.list_applications),
+            ('frameworks', shipa.list_frameworks),
+            ('clusters', shipa.list_clusters),
+            ('jobs', shipa.list_jobs),
+        )
+
+        def fetch(listing):
+            kind, list_resources = listing
+            try:
+                ok, resp = list_resources()
+            except shipa_client.ShipaError as e:
+                raise AnsibleParserError('failed to list shipa {}: {}'.format(kind, e))
+            except Exception as e:
+                raise AnsibleParserError(
+                    'failed to list shipa {}: {}: {}'.format(kind, type(e).__name__, e), orig_exc=e
+                )
+            if not ok:
+                raise AnsibleParserError('failed to list shipa {}: {}'.format(kind, resp.message))
+            return kind, resp.json or []
+
+        executor = ThreadPoolExecutor(max_workers=max(1, self.get_option('concurrency')))
+        try:
+            return dict(executor.map(fetch, listings))
+        finally:
+            executor.shutdown()
+
+    def _populate(self, resources):
+        strict = self.get_option('strict')
+
+        self.inventory.add_group('shipa_apps')
+        for name, value in (('shipa_frameworks', resources['frameworks']),
+                            ('shipa_clusters', resources['clusters']),
+                            ('shipa_jobs', resources['jobs'])):
+            self.inventory.set_variable('all', name, value)
+
+        for cluster in resources['clusters']:
+            cluster_group = self.inventory.add_group(self._sanitize_group_name('shipa_cluster_{}'.format(cluster.get('name'))))
+            for framework in ((cluster.get('resources') or {}).get('frameworks') or []):
+                framework_group = self.inventory.add_group(
+                    self._sanitize_group_name('shipa_framework_{}'.format(framework.get('name')))
+                )
+                self.inventory.add_child(cluster_group, framework_group)
+
+        for app in resources['apps']:
+            host = self.inventory.add_host(app.get('name'), group='shipa_apps')
+            self.inventory.set_variable(host, 'shipa_app', app)
+
+            framework = app.get('pool') or app.get('framework')
+            if framework:
+                group = self.inventory.add_group(self._sanitize_group_name('shipa_framework_{}'.format(framework)))
+                self.inventory.add_host(host, group=group)
+
+            team = app.get('teamowner') or app.get('teamOwner')
+            if team:
+                group = self.inventory.add_group(self._sanitize_group_name('shipa_team_{}'.format(team)))
+                self.inventory.add_host(host, group=group)
+
+            hostvars = self.inventory.get_host(host).get_vars()
+            self._set_composite_vars(self.get_option('compose'), hostvars, host, strict=strict)
+            self._add_host_to_composed_groups(self.get_option('groups'), hostvars, host, strict=strict)
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), hostvars, host, strict=strict)
@@ -12,42 +12,63 @@ short_description: Shipa app-cname module
 
 version_added: "0.0.1"
 
-description: This is module allows to create Shipa app cname.
+description:
+    - This is module allows to create Shipa app cname.
+    - Cnames already set on the application with the same scheme are not sent again.
+
+notes:
+    - Supports check mode, cnames to add and remove are reported, nothing is written.
+
+extends_documentation_fragment: shipa
 
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     app:
         description: Shipa application name.
         required: true
         type: str
     cname:
         description: Shipa application cname.
-        required: true
+        required: false
         type: str
     encrypt:
-        description: Shipa application cname scheme type: http/https.
-        required: true
+        description: Shipa application cname scheme type: http/https, required with cname.
+        required: false
+        type: bool
+    cnames:
+        description:
+            - Full list of Shipa application cnames, reconciled in one pass.
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            cname:
+                description: Shipa application cname.
+                required: true
+                type: str
+            encrypt:
+                description: Shipa application cname scheme type: http/https.
+                required: false
+                type: bool
+                default: false
+    exclusive:
+        description: With cnames, remove cnames set on the application that are not listed.
+        required: false
         type: bool
+        default: false
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import (
+    APP_CNAME_CONSTRAINTS, app_cname_spec, reconcile_app_cname, run_reconcile,
+)
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
+    module_args = shipa_argument_spec()
+    module_args.update(app_cname_spec())
+    module_args.update(
         app=dict(type='str', required=True),
-        cname=dict(type='str', required=True),
-        encrypt=dict(type='bool', required=True),
     )
 
     result = dict(
@@ -58,6 +79,8 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        supports_check_mode=True,
+        **APP_CNAME_CONSTRAINTS
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -65,29 +88,12 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
-    payload = {
-        key: module.params.get(key) for key in keys
-    }
-
-    scheme = 'http'
-    if payload.get('encrypt'):
-        scheme = 'https'
-    payload['scheme'] = scheme
-
-    name = module.params['app']
-    exists, resp = shipa.get_application(name)
-    if not exists:
-        module.fail_json(msg=resp)
-
-    ok, resp = shipa.create_app_cname(payload)
-
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
+    changed, resource, details = run_reconcile(module, shipa, reconcile_app_cname, module.params['app'], module.params)
 
     result['status'] = "SUCCESS"
-    result['shipa_app_cname'] = resp
-    result['changed'] = True
+    result['shipa_app_cname'] = resource
+    result['cnames'] = details['cnames']
+    result['changed'] = changed
 
     module.exit_json(**result)
 
@@ -12,17 +12,17 @@ short_description: Shipa app deploy module
 
 version_added: "0.0.1"
 
-description: This is module allows to deploy Shipa application.
+description:
+    - This is module allows to deploy Shipa application.
+    - A fingerprint of every successful deploy request is kept on the host running the module,
+      deploying the same request again is skipped unless force is set.
+
+notes:
+    - Supports check mode, a deploy is planned when its fingerprint differs from the recorded one, the deploy is not submitted.
+
+extends_documentation_fragment: shipa
 
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     app:
         description: Shipa application name.
         required: true
@@ -56,25 +56,39 @@ options:
         description: Volumes options.
         required: false
         type: list
+    force:
+        description: Deploy even when the same request was already deployed.
+        required: false
+        type: bool
+        default: false
+    wait:
+        description:
+            - Wait for deploys accepted by the server to finish, polling their status with exponential backoff.
+            - When false the module returns as soon as the deploy is accepted, with status PENDING.
+            - Servers that do not serve GET /deploys cannot report the deploy, it is returned as PENDING with a warning.
+        required: false
+        type: bool
+        default: true
+    wait_timeout:
+        description:
+            - How long the whole deploy may take, as a duration e.g. 90s, 10m or 1h30m.
+            - It bounds both a deploy the server streams the output of and the polling of an accepted deploy,
+              the task fails when it expires. The deploy itself is not cancelled.
+        required: false
+        type: str
+        default: 25m
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import app_deploy_spec, reconcile_app_deploy, run_reconcile
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
+    module_args = shipa_argument_spec()
+    module_args.update(app_deploy_spec())
+    module_args.update(
         app=dict(type='str', required=True),
-        image=dict(type='str', required=True),
-
-        appConfig=dict(type='dict', required=False),
-        canarySettings=dict(type='dict', required=False),
-        podAutoScaler=dict(type='dict', required=False),
-        port=dict(type='dict', required=False),
-        registry=dict(type='dict', required=False),
-        volumes=dict(type='list', required=False),
     )
 
     result = dict(
@@ -85,6 +99,7 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        supports_check_mode=True,
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -92,34 +107,12 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
-    req = {
-        key: module.params.get(key) for key in keys
-    }
-
-    if req.get('port') and req['port'].get('protocol', '') == '':
-        req['port']['protocol'] = "TCP"
-
-    if req.get('volumes'):
-        volumes = []
-        for v in req.get('volumes'):
-            vol = {
-                'volumeName': v.get('name'),
-                'volumeMountPath': v.get('mountPath'),
-            }
-            if v.get('mountOptions'):
-                vol['volumeMountOptions'] = v.get('mountOptions')
-            volumes.append(vol)
-        req['volumesToBind'] = volumes
-        del req['volumes']
-
-    ok, resp = shipa.deploy_app(req)
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
-
-    result['status'] = 'SUCCESS'
-    result['shipa_app_deploy'] = resp
-    result['changed'] = True
+    changed, resource, details = run_reconcile(module, shipa, reconcile_app_deploy, module.params['app'], module.params)
+
+    result['status'] = 'PENDING' if details.pop('pending') else 'SUCCESS'
+    result['shipa_app_deploy'] = resource
+    result['changed'] = changed
+    result.update(details)
 
     module.exit_json(**result)
 
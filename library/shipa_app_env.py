@@ -12,47 +12,113 @@ short_description: Shipa app-env module
 
 version_added: "0.0.1"
 
-description: This is module allows to create Shipa app env.
+description:
+    - This is module allows to create Shipa app env.
+    - Only envs that are missing or differ from the current ones are sent, nothing is sent
+      and the app is not restarted when all envs are already set.
+
+notes:
+    - Supports check mode, envs are read once and the planned delta is reported, nothing is written.
+    - With apps or app_envs every app gets its own report, failures of one app, connection and auth errors
+      included, are reported as FAILED for that app and the task fails once all apps are done.
+
+extends_documentation_fragment: shipa
 
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     app:
         description: Shipa application name.
-        required: true
+        required: false
         type: str
+    apps:
+        description: Shipa application names, envs are applied to each of them.
+        required: false
+        type: list
+        elements: str
+    app_envs:
+        description:
+            - Mapping of Shipa application name to the envs to apply to it, a list of name/value dicts.
+            - Every app is validated before any envs are written.
+        required: false
+        type: dict
     envs:
-        description: Shipa application envs.
-        required: true
+        description: Shipa application envs, required with app or apps.
+        required: false
         type: list
+        elements: dict
+    exclusive:
+        description:
+            - Remove envs set on the application that are not listed in envs.
+            - Platform envs (SHIPA_*, TSURU_*) are never removed.
+        required: false
+        type: bool
+        default: false
+    concurrency:
+        description: Number of applications updated in parallel with apps or app_envs.
+        required: false
+        type: int
+        default: 10
     norestart:
         description: Shipa app envs norestart flag.
         required: false
         type: bool
     private:
-        description: Shipa app envs private flag.
+        description:
+            - Shipa app envs private flag.
+            - The API masks private values, a fingerprint of the values last set is kept in shipa_cache_dir
+              to skip unchanged private envs. Without one, e.g. on a new controller, they are set again.
         required: false
         type: bool
 '''
 
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, ShipaError, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import (
+    Context, ReconcileError, app_env_spec, reconcile_app_env, run_reconcile,
+)
+
+
+def invalid_envs(targets):
+    """ Apps whose envs are not a list of name/value dicts, checked before anything is written """
+    return sorted(
+        app for app, envs in targets
+        if not isinstance(envs, list) or not all(isinstance(env, dict) and env.get('name') for env in envs)
+    )
+
+
+def apply_bulk(ctx, targets, spec, concurrency):
+    def apply(target):
+        app, envs = target
+        started = time.time()
+        try:
+            changed, resource, details = reconcile_app_env(ctx, app, dict(spec, envs=envs))
+            report = dict(changed=changed, status='SUCCESS', shipa_app_env=resource, **details)
+        except (ReconcileError, ShipaError) as e:
+            report = dict(changed=False, status='FAILED', msg=getattr(e, 'msg', str(e)))
+        except Exception as e:
+            report = dict(changed=False, status='FAILED', msg='{}: {}'.format(type(e).__name__, e),
+                          exception=traceback.format_exc())
+        report['elapsed'] = round(time.time() - started, 3)
+        return app, report
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        return dict(executor.map(ctx.shipa.worker(apply), targets))
+    finally:
+        executor.shutdown()
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
-        app=dict(type='str', required=True),
-        envs=dict(type='list', required=True),
-        norestart=dict(type='bool', default=False),
-        private=dict(type='bool', default=False),
+    module_args = shipa_argument_spec()
+    module_args.update(app_env_spec())
+    module_args.update(
+        app=dict(type='str', required=False),
+        apps=dict(type='list', elements='str', required=False),
+        app_envs=dict(type='dict', required=False),
+        concurrency=dict(type='int', default=10),
     )
 
     result = dict(
@@ -63,6 +129,10 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        mutually_exclusive=[('app', 'apps', 'app_envs')],
+        required_one_of=[('app', 'apps', 'app_envs')],
+        required_by={'app': 'envs', 'apps': 'envs'},
+        supports_check_mode=True,
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -70,24 +140,37 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
-    payload = {
-        key: module.params.get(key) for key in keys
-    }
-
     name = module.params['app']
-    exists, resp = shipa.get_application(name)
-    if not exists:
-        module.fail_json(msg=resp)
-
-    ok, resp = shipa.create_app_env(payload)
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
+    if name:
+        changed, resource, details = run_reconcile(module, shipa, reconcile_app_env, name, module.params)
+
+        result['status'] = "SUCCESS"
+        result['shipa_app_env'] = resource
+        result['envs'] = details['envs']
+        result['changed'] = changed
+        module.exit_json(**result)
+
+    if module.params['app_envs']:
+        targets = list(module.params['app_envs'].items())
+    else:
+        targets = [(app, module.params['envs']) for app in module.params['apps']]
+    invalid = invalid_envs(targets)
+    if invalid:
+        module.fail_json(msg='envs must be a list of name/value dicts, invalid for apps: {}'.format(', '.join(invalid)))
+
+    started = time.time()
+    spec = dict((key, module.params[key]) for key in app_env_spec())
+    apps = apply_bulk(Context(shipa, module.check_mode), targets, spec, module.params['concurrency'])
+
+    result['apps'] = apps
+    result['elapsed'] = round(time.time() - started, 3)
+    result['changed'] = any(report['changed'] for report in apps.values())
+
+    failed = sorted(app for app, report in apps.items() if report['status'] != 'SUCCESS')
+    if failed:
+        module.fail_json(msg='failed to set envs for apps: {}'.format(', '.join(failed)), **result)
 
     result['status'] = "SUCCESS"
-    result['shipa_app_env'] = resp
-    result['changed'] = True
-
     module.exit_json(**result)
 
 
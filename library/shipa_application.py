@@ -14,15 +14,12 @@ version_added: "0.0.1"
 
 description: This is module allows to create Shipa application.
 
+notes:
+    - Supports check mode, the planned changes are computed from the current application, nothing is written.
+
+extends_documentation_fragment: shipa
+
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     name:
         description: Shipa application name.
         required: true
@@ -84,33 +81,34 @@ options:
         description: Shipa application status.
         required: false
         type: str
+    refresh:
+        description:
+            - Read the application back after writing it.
+            - By default the application returned by the create or update call is used, it is only read back
+              when that response does not hold it.
+        required: false
+        type: bool
+        default: false
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import application_spec, reconcile_application, run_reconcile
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
-        name=dict(type='str', required=True),
-        framework=dict(type='str', required=True),
-        teamowner=dict(type='str', required=True),
-        plan=dict(type='str', required=True),
-        tags=dict(type='list', required=True),
-
-        # description=dict(type='str', required=False),
-        # units=dict(type='list', required=False),
-        # cname=dict(type='list', required=False),
-        # ip=dict(type='str', required=False),
-        # org=dict(type='str', required=False),
-        # entrypoints=dict(type='list', required=False),
-        # routers=dict(type='list', required=False),
-        # lock=dict(type='dict', required=False),
-        # platform=dict(type='str', required=False),
-        # status=dict(type='str', required=False),
-    )
+    module_args = shipa_argument_spec()
+    module_args.update(application_spec())
+    # description=dict(type='str', required=False),
+    # units=dict(type='list', required=False),
+    # cname=dict(type='list', required=False),
+    # ip=dict(type='str', required=False),
+    # org=dict(type='str', required=False),
+    # entrypoints=dict(type='list', required=False),
+    # routers=dict(type='list', required=False),
+    # lock=dict(type='dict', required=False),
+    # platform=dict(type='str', required=False),
+    # status=dict(type='str', required=False),
 
     result = dict(
         changed=False,
@@ -120,6 +118,7 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        supports_check_mode=True,
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -127,40 +126,12 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
-    app = {
-        key: module.params.get(key) for key in keys
-    }
-    app['pool'] = app['framework']
-    del app['framework']
-    app['teamOwner'] = app['teamowner']
-    del app['teamowner']
-
-    name = module.params['name']
-    exists, current_state = shipa.get_application(name)
-
-    if exists:
-        ok, resp = shipa.update_application(name, app)
-    else:
-        ok, resp = shipa.create_application(app)
-
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
-
-    ok, resp = shipa.get_application(name)
-    if not ok:
-        module.fail_json(msg=resp)
-
-    ignore_field = 'updatedAt'
-    if ignore_field in resp:
-        del resp[ignore_field]
-    if ignore_field in current_state:
-        del current_state[ignore_field]
-
-    changed = not exists or current_state != resp
+    changed, resource, details = run_reconcile(module, shipa, reconcile_application, module.params)
+    if module._diff:
+        result['diff'] = details['diff']
 
     result['status'] = "SUCCESS"
-    result['shipa_application'] = resp
+    result['shipa_application'] = resource
     result['changed'] = changed
 
     module.exit_json(**result)
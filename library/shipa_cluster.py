@@ -4,8 +4,6 @@ from __future__ import (absolute_import, division, print_function)
 
 __metaclass__ = type
 
-import os.path
-
 DOCUMENTATION = r'''
 ---
 module: shipa_cluster
@@ -16,15 +14,15 @@ version_added: "0.0.1"
 
 description: This is module allows to create Shipa cluster.
 
+notes:
+    - Supports check mode, the planned changes are computed from the current cluster, nothing is written.
+    - The endpoint caCert and token are never compared with the ones the API returns, if it returns them, and are
+      redacted from the result. A fingerprint of the applied payload, secrets included, is kept in shipa_cache_dir,
+      the update is skipped when neither it nor the cluster read from the API changed.
+
+extends_documentation_fragment: shipa
+
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     name:
         description: Shipa cluster name.
         required: true
@@ -37,20 +35,29 @@ options:
         description: Shipa cluster resources.
         required: true
         type: dict
+    refresh:
+        description:
+            - Read the cluster back after writing it.
+            - By default the cluster returned by the create or update call is used, it is only read back
+              when that response does not hold it.
+        required: false
+        type: bool
+        default: false
+    force:
+        description: Update the cluster even if it matches the fingerprint of the last update.
+        required: false
+        type: bool
+        default: false
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import cluster_spec, reconcile_cluster, run_reconcile
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
-        name=dict(type='str', required=True),
-        endpoint=dict(type='dict', required=True, no_log=True),
-        resources=dict(type='dict', required=True),
-    )
+    module_args = shipa_argument_spec()
+    module_args.update(cluster_spec())
 
     result = dict(
         changed=False,
@@ -60,6 +67,7 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        supports_check_mode=True,
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -67,40 +75,13 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
-    payload = {
-        key: module.params.get(key) for key in keys
-    }
-
-    cert = payload['endpoint'].get('caCert')
-    if cert and os.path.exists(cert):
-        with open(cert) as f:
-            payload['endpoint']['caCert'] = f.read().strip(' \n')
-
-    token = payload['endpoint'].get('token')
-    if token and os.path.exists(token):
-        with open(token) as f:
-            payload['endpoint']['token'] = f.read().strip(' \n')
-
-    name = module.params['name']
-    exists, current_state = shipa.get_cluster(name)
-
-    if exists:
-        ok, resp = shipa.update_cluster(name, payload)
-    else:
-        ok, resp = shipa.create_cluster(payload)
-
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
-
-    ok, resp = shipa.get_cluster(name)
-    if not ok:
-        module.fail_json(msg=resp)
-
-    changed = not exists or current_state != resp
+    changed, resource, details = run_reconcile(module, shipa, reconcile_cluster, module.params)
+    if module._diff:
+        result['diff'] = details['diff']
 
     result['status'] = "SUCCESS"
-    result['shipa_cluster'] = resp
+    result['shipa_cluster'] = resource
+    result['fingerprint'] = details['fingerprint']
     result['changed'] = changed
 
     module.exit_json(**result)
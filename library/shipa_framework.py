@@ -14,15 +14,14 @@ version_added: "0.0.1"
 
 description: This is module allows to create Shipa framework.
 
+notes:
+    - Supports check mode, the planned changes are computed from the current framework, nothing is written.
+    - With merge, several tasks can each own a section of the same framework, e.g. general.security.ignoreCves
+      or general.networkPolicy, without overwriting the others.
+
+extends_documentation_fragment: shipa
+
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     name:
         description: Shipa framework name.
         required: true
@@ -31,19 +30,32 @@ options:
         description: Shipa framework resources.
         required: false
         type: dict
+    merge:
+        description:
+            - Deep-merge resources into the resources of the existing framework instead of replacing them.
+              Nested dicts are merged, lists and other values replace the current ones.
+            - The framework is only updated when the merged resources differ from the current ones.
+        required: false
+        type: bool
+        default: false
+    refresh:
+        description:
+            - Read the framework back after writing it.
+            - By default the framework returned by the create or update call is used, it is only read back
+              when that response does not hold it.
+        required: false
+        type: bool
+        default: false
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import framework_spec, reconcile_framework, run_reconcile
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
-        name=dict(type='str', required=True),
-        resources=dict(type='dict', required=False),
-    )
+    module_args = shipa_argument_spec()
+    module_args.update(framework_spec())
 
     result = dict(
         changed=False,
@@ -53,6 +65,7 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        supports_check_mode=True,
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -60,24 +73,12 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    name, resources = module.params['name'], module.params.get('resources')
-    exists, current_state = shipa.get_framework(name)
-    if exists:
-        ok, resp = shipa.update_framework(name, resources)
-    else:
-        ok, resp = shipa.create_framework(name, resources)
-
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
-
-    ok, resp = shipa.get_framework(name)
-    if not ok:
-        module.fail_json(msg=resp)
-
-    changed = not exists or current_state != resp
+    changed, resource, details = run_reconcile(module, shipa, reconcile_framework, module.params)
+    if module._diff:
+        result['diff'] = details['diff']
 
     result['status'] = "SUCCESS"
-    result['shipa_framework'] = resp
+    result['shipa_framework'] = resource
     result['changed'] = changed
 
     module.exit_json(**result)
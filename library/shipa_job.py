@@ -13,32 +13,34 @@ short_description: Shipa job module
 
 version_added: "0.0.1"
 
-description: This is module allows to create Shipa job.
+description:
+    - This is module allows to create Shipa job.
+    - With jobs, a batch of jobs is submitted in one task. The existing jobs are listed once, jobs are deduplicated
+      by name and the missing ones created concurrently, with a result per job.
+
+notes:
+    - Supports check mode, a job that does not exist is reported as changed without creating it.
+    - With wait the task returns the final job and its job_status, and fails when the job failed
+      or wait_timeout expired.
+
+extends_documentation_fragment: shipa
 
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     name:
-        description: Shipa job name.
-        required: true
+        description: Shipa job name, required unless jobs is given.
+        required: false
         type: str
     framework:
-        description: Shipa framework name.
-        required: true
+        description: Shipa framework name, required with name.
+        required: false
         type: str
     containers:
-        description: Shipa job containers.
-        required: true
+        description: Shipa job containers, required with name.
+        required: false
         type: list
     policy:
-        description: Shipa job policy.
-        required: true
+        description: Shipa job policy, required with name.
+        required: false
         type: dict
     
     description:
@@ -73,20 +75,126 @@ options:
         description: Shipa job version.
         required: false
         type: str
+
+    wait:
+        description: Wait for the job to complete, polling it with exponential backoff.
+        required: false
+        type: bool
+        default: false
+    wait_timeout:
+        description: How long to wait for the job, e.g. 90s, 10m or 1h.
+        required: false
+        type: str
+        default: 10m
+    jobs:
+        description:
+            - Job specs submitted as a batch, each with the job options above, name included.
+            - Only the first spec of a name is used. Jobs that already exist are left as they are.
+            - With wait, all jobs of the batch are polled together with one list call per poll.
+        required: false
+        type: list
+        elements: dict
+    concurrency:
+        description: Number of jobs created in parallel with jobs.
+        required: false
+        type: int
+        default: 10
 '''
 
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import (
+    Client, ShipaError, diff_output, job_counts, job_status, parse_duration, resource_diff, shipa_argument_spec,
+)
+
+# options of the module itself, not part of the job
+MODULE_OPTIONS = ('wait', 'wait_timeout', 'jobs', 'concurrency')
+
+
+def wait_report(job, started):
+    """ job_status of a job that was waited for, job is None when it was never seen """
+    job = job or {}
+    done, succeeded = job_status(job) if job else (False, False)
+    return dict(
+        job_counts(job),
+        status='succeeded' if succeeded else 'failed' if done else 'timeout',
+        completions=job.get('completions') or 1,
+        elapsed=round(time.time() - started, 3),
+    )
+
+
+def submit_batch(shipa, specs, concurrency, check_mode=False):
+    def submit(spec):
+        started = time.time()
+        report = dict(changed=True, status='SUCCESS')
+        if not check_mode:
+            try:
+                ok, resp = shipa.create_job(spec)
+                if not ok:
+                    report = dict(changed=False, status='FAILED', msg=resp.message)
+            except ShipaError as e:
+                report = dict(changed=False, status='FAILED', msg=str(e))
+        report['elapsed'] = round(time.time() - started, 3)
+        return spec['name'], report
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        return dict(executor.map(shipa.worker(submit), specs))
+    finally:
+        executor.shutdown()
+
+
+def run_batch(module, shipa, timeout, result):
+    specs = module.params['jobs']
+    if not all(isinstance(spec, dict) and spec.get('name') for spec in specs):
+        module.fail_json(msg='every item of jobs needs a name')
+
+    started = time.time()
+    ok, resp = shipa.list_jobs()
+    if not ok:
+        module.fail_json(msg=resp.message)
+    existing = set(job.get('name') for job in resp.json or [])
+
+    unique = {}
+    for spec in specs:
+        unique.setdefault(spec['name'], spec)
+    missing = [spec for name, spec in unique.items() if name not in existing]
+
+    jobs = dict((name, dict(changed=False, status='SUCCESS')) for name in unique if name in existing)
+    jobs.update(submit_batch(shipa, missing, module.params['concurrency'], module.check_mode))
+
+    if module.params['wait'] and not module.check_mode:
+        names = [name for name, report in jobs.items() if report['status'] == 'SUCCESS']
+        _, states = shipa.wait_for_jobs(names, max(0, timeout - (time.time() - started)))
+        for name in names:
+            jobs[name]['job_status'] = wait_report(states.get(name), started)
+            if jobs[name]['job_status']['status'] != 'succeeded':
+                jobs[name]['status'] = 'FAILED'
+
+    result.pop('shipa_job')
+    result['jobs'] = jobs
+    result['duplicates'] = sorted(name for name, count in Counter(spec['name'] for spec in specs).items() if count > 1)
+    result['elapsed'] = round(time.time() - started, 3)
+    result['changed'] = any(report['changed'] for report in jobs.values())
+
+    failed = sorted(name for name, report in jobs.items() if report['status'] != 'SUCCESS')
+    if failed:
+        module.fail_json(msg='failed jobs: {}'.format(', '.join(failed)), **result)
+
+    result['status'] = "SUCCESS"
+    module.exit_json(**result)
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
-        name=dict(type='str', required=True),
-        framework=dict(type='str', required=True),
-        containers=dict(type='list', required=True),
-        policy=dict(type='dict', required=True),
+    module_args = shipa_argument_spec()
+    module_args.update(
+        name=dict(type='str', required=False),
+        framework=dict(type='str', required=False),
+        containers=dict(type='list', required=False),
+        policy=dict(type='dict', required=False),
 
         description=dict(type='str', required=False),
         backoffLimit=dict(type='int', required=False),
@@ -96,6 +204,11 @@ def run_module():
         team=dict(type='str', required=False),
         type=dict(type='str', required=False),
         version=dict(type='str', required=False),
+
+        wait=dict(type='bool', default=False),
+        wait_timeout=dict(type='str', default='10m'),
+        jobs=dict(type='list', elements='dict', required=False),
+        concurrency=dict(type='int', default=10),
     )
 
     result = dict(
@@ -106,30 +219,62 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        mutually_exclusive=[('name', 'jobs')],
+        required_one_of=[('name', 'jobs')],
+        required_by={'name': ('framework', 'containers', 'policy')},
+        supports_check_mode=True,
     )
 
+    try:
+        timeout = parse_duration(module.params['wait_timeout']).total_seconds()
+    except AssertionError as e:
+        module.fail_json(msg=str(e))
+
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
     ok, err = shipa.test_access()
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
+    if module.params['jobs'] is not None:
+        run_batch(module, shipa, timeout, result)
+
+    keys = filter(lambda key: not key.startswith('shipa_') and key not in MODULE_OPTIONS, module_args.keys())
     job = {
         key: module.params.get(key) for key in keys
     }
 
     name = module.params['name']
     exists, current_state = shipa.get_job(name)
+
+    if module.check_mode:
+        result['status'] = "SUCCESS"
+        result['shipa_job'] = current_state if exists else {}
+        result['changed'] = not exists
+        module.exit_json(**result)
+
+    started = time.time()
     if not exists:
         ok, resp = shipa.create_job(job)
-        if not ok or '"error"' in str(resp).lower():
-            module.fail_json(msg=resp)
+        if not ok:
+            module.fail_json(msg=resp.message)
+
+    if module.params['wait']:
+        _, jobs = shipa.wait_for_jobs([name], timeout)
+        result['job_status'] = wait_report(jobs.get(name), started)
+        if result['job_status']['status'] == 'timeout':
+            module.fail_json(msg='timed out after {} waiting for job {}'.format(module.params['wait_timeout'], name),
+                             **result)
+        if result['job_status']['status'] == 'failed':
+            module.fail_json(msg='job {} failed'.format(name), **result)
 
     ok, resp = shipa.get_job(name)
     if not ok:
-        module.fail_json(msg=resp)
+        module.fail_json(msg='job {} not found'.format(name))
 
-    changed = not exists or current_state != resp
+    changes = resource_diff('job', current_state if exists else {}, resp)
+    changed = not exists or bool(changes)
+    if module._diff:
+        result['diff'] = diff_output(changes)
 
     result['status'] = "SUCCESS"
     result['shipa_job'] = resp
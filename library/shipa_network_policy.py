@@ -12,17 +12,17 @@ short_description: Shipa network policy module
 
 version_added: "0.0.1"
 
-description: This is module allows to create Shipa network policy.
+description:
+    - This is module allows to create Shipa network policy.
+    - The policy is not written, and the app not restarted, when the current one is equivalent,
+      regardless of rule ordering and default values.
+
+notes:
+    - Supports check mode, the current policy is compared with the desired one, nothing is written.
+
+extends_documentation_fragment: shipa
 
 options:
-    shipa_host:
-        description: Shipa server host.
-        required: true
-        type: str
-    shipa_token:
-        description: Shipa API token.
-        required: true
-        type: str
     app:
         description: Shipa application name.
         required: true
@@ -42,17 +42,15 @@ options:
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.shipa_client import Client
+from ansible.module_utils.shipa_client import Client, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import network_policy_spec, reconcile_network_policy, run_reconcile
 
 
 def run_module():
-    module_args = dict(
-        shipa_host=dict(type='str', required=True, no_log=True),
-        shipa_token=dict(type='str', required=True, no_log=True),
+    module_args = shipa_argument_spec()
+    module_args.update(network_policy_spec())
+    module_args.update(
         app=dict(type='str', required=True),
-        ingress=dict(type='dict', required=False),
-        egress=dict(type='dict', required=False),
-        restart_app=dict(type='bool', default=False),
     )
 
     result = dict(
@@ -63,6 +61,7 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        supports_check_mode=True,
     )
 
     shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
@@ -70,27 +69,18 @@ def run_module():
     if not ok:
         module.fail_json(msg=err)
 
-    keys = filter(lambda key: not key.startswith('shipa_'), module_args.keys())
-    payload = {
-        key: module.params.get(key) for key in keys
-    }
-
     name = module.params['app']
     exists, resp = shipa.get_application(name)
     if not exists:
-        module.fail_json(msg=resp)
+        module.fail_json(msg=resp.message)
 
-    ok, resp = shipa.create_network_policy(payload)
-    if not ok or '"error"' in str(resp).lower():
-        module.fail_json(msg=resp)
-
-    ok, resp = shipa.get_network_policy(name)
-    if not ok:
-        module.fail_json(msg=resp)
+    changed, resource, details = run_reconcile(module, shipa, reconcile_network_policy, name, module.params)
+    if module._diff and 'diff' in details:
+        result['diff'] = details['diff']
 
     result['status'] = "SUCCESS"
-    result['shipa_network_policy'] = resp
-    result['changed'] = True
+    result['shipa_network_policy'] = resource
+    result['changed'] = changed
 
     module.exit_json(**result)
 
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: shipa_state
+
+short_description: Shipa desired state module
+
+version_added: "0.0.1"
+
+description:
+    - This is module allows to apply a whole Shipa desired state in one task.
+    - Resources are reconciled as a dependency graph, frameworks before the clusters using them, clusters
+      before the applications of their frameworks, applications before their envs, cnames and network policy,
+      and those before the application deploy. Independent branches are reconciled concurrently.
+    - The document is validated against the module options of each resource before anything is written.
+    - A resource that fails, API and connection errors included, is reported as FAILED in shipa_state,
+      the resources depending on it are skipped and the others still reconciled.
+
+notes:
+    - Supports check mode, every resource is read at most once and its planned change reported, nothing is
+      written. Sub-resources of applications that do not exist yet are planned without reading them.
+
+extends_documentation_fragment: shipa
+
+options:
+    state:
+        description:
+            - Desired state document with frameworks, clusters and apps lists.
+            - Frameworks take the shipa_framework options, clusters the shipa_cluster options
+              and apps the shipa_application options.
+            - An app may also hold env (shipa_app_env options), cname (shipa_app_cname options),
+              network_policy (shipa_network_policy options) and deploy (shipa_app_deploy options),
+              the app name is implied.
+            - Resources of a kind must have distinct names.
+        required: true
+        type: dict
+    concurrency:
+        description: Number of resources reconciled in parallel, per level of the graph.
+        required: false
+        type: dict
+        suboptions:
+            frameworks:
+                description: Frameworks reconciled in parallel.
+                type: int
+                default: 4
+            clusters:
+                description: Clusters reconciled in parallel.
+                type: int
+                default: 4
+            apps:
+                description: Applications reconciled in parallel.
+                type: int
+                default: 8
+            app_resources:
+                description: Application envs, cnames and network policies reconciled in parallel.
+                type: int
+                default: 8
+            deploys:
+                description: Application deploys running in parallel.
+                type: int
+                default: 4
+'''
+
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.shipa_client import Client, ShipaError, shipa_argument_spec
+from ansible.module_utils.shipa_reconcile import (
+    APP_CNAME_CONSTRAINTS, Context, ReconcileError, app_cname_spec, app_deploy_spec, app_env_spec, application_spec,
+    cluster_spec, framework_spec, network_policy_spec, reconcile_app_cname, reconcile_app_deploy, reconcile_app_env,
+    reconcile_application, reconcile_cluster, reconcile_framework, reconcile_network_policy,
+)
+
+LEVELS = ('frameworks', 'clusters', 'apps', 'app_resources', 'deploys')
+
+
+def state_spec():
+    """ Options of the state document, validated before anything is reconciled """
+    app = application_spec()
+    app.update(
+        env=dict(type='dict', options=app_env_spec()),
+        cname=dict(type='dict', options=app_cname_spec(), **APP_CNAME_CONSTRAINTS),
+        network_policy=dict(type='dict', options=network_policy_spec()),
+        deploy=dict(type='dict', options=app_deploy_spec()),
+    )
+    return dict(
+        frameworks=dict(type='list', elements='dict', options=framework_spec()),
+        clusters=dict(type='list', elements='dict', options=cluster_spec()),
+        apps=dict(type='list', elements='dict', options=app),
+    )
+
+
+def duplicate_names(state):
+    """ Resources named more than once in the state document, e.g. apps/web """
+    duplicates = []
+    for section in ('frameworks', 'clusters', 'apps'):
+        seen = set()
+        for spec in state.get(section) or []:
+            if spec['name'] in seen:
+                duplicates.append('{}/{}'.format(section, spec['name']))
+            seen.add(spec['name'])
+    return sorted(set(duplicates))
+
+
+def build_graph(ctx, state):
+    """
+    Nodes of the desired state graph.
+
+    :return dict: node key -> (level, dependency keys, reconcile function)
+    """
+    nodes = {}
+    frameworks = set(spec['name'] for spec in state.get('frameworks') or [])
+
+    for spec in state.get('frameworks') or []:
+        nodes['framework/{}'.format(spec['name'])] = ('frameworks', [], lambda spec=spec: reconcile_framework(ctx, spec))
+
+    # framework -> clusters it is bound to
+    framework_clusters = {}
+    for spec in state.get('clusters') or []:
+        deps = []
+        for framework in ((spec.get('resources') or {}).get('frameworks') or []):
+            framework_clusters.setdefault(framework.get('name'), []).append('cluster/{}'.format(spec['name']))
+            if framework.get('name') in frameworks:
+                deps.append('framework/{}'.format(framework.get('name')))
+        nodes['cluster/{}'.format(spec['name'])] = ('clusters', deps, lambda spec=spec: reconcile_cluster(ctx, spec))
+
+    sub_resources = (
+        ('env', reconcile_app_env),
+        ('cname', reconcile_app_cname),
+        ('network_policy', reconcile_network_policy),
+    )
+    for spec in state.get('apps') or []:
+        name = spec['name']
+        app_key = 'app/{}'.format(name)
+        deps = list(framework_clusters.get(spec.get('framework'), []))
+        if spec.get('framework') in frameworks:
+            deps.append('framework/{}'.format(spec.get('framework')))
+        nodes[app_key] = ('apps', deps, lambda spec=spec: reconcile_application(ctx, spec))
+
+        deploy_deps = [app_key]
+        for kind, reconcile in sub_resources:
+            if spec.get(kind):
+                key = '{}/{}'.format(app_key, kind)
+                nodes[key] = ('app_resources', [app_key],
+                              lambda reconcile=reconcile, name=name, sub=spec[kind]: reconcile(ctx, name, sub))
+                deploy_deps.append(key)
+
+        if spec.get('deploy'):
+            nodes['{}/deploy'.format(app_key)] = ('deploys', deploy_deps,
+                                                  lambda name=name, sub=spec['deploy']: reconcile_app_deploy(ctx, name, sub))
+
+    return nodes
+
+
+def run_node(reconcile):
+    """ Reconcile one node, whatever goes wrong ends up in its report rather than aborting the graph """
+    started = time.time()
+    try:
+        changed, resource, details = reconcile()
+        details.pop('diff', None)
+        report = dict(details, status='SUCCESS', changed=changed, result=resource)
+    except ReconcileError as e:
+        report = dict(e.details, status='FAILED', changed=False, msg=e.msg)
+    except ShipaError as e:
+        report = dict(status='FAILED', changed=False, msg=str(e))
+    except Exception as e:
+        report = dict(status='FAILED', changed=False, msg='{}: {}'.format(type(e).__name__, e),
+                      exception=traceback.format_exc())
+    report['elapsed'] = round(time.time() - started, 3)
+    return report
+
+
+def run_graph(ctx, nodes, concurrency):
+    """ Reconcile every node once its dependencies succeeded, bounding the nodes running per level """
+    reports, pending, running = {}, dict(nodes), {}
+    busy = dict((level, 0) for level in LEVELS)
+
+    executor = ThreadPoolExecutor(max_workers=sum(concurrency.values()))
+    try:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for key in sorted(pending):
+                    level, deps, reconcile = pending[key]
+                    deps = [dep for dep in deps if dep in nodes]
+                    if any(reports.get(dep, {}).get('status') in ('FAILED', 'SKIPPED') for dep in deps):
+                        reports[key] = dict(status='SKIPPED', changed=False, msg='dependency failed')
+                    elif all(dep in reports for dep in deps) and busy[level] < concurrency[level]:
+                        busy[level] += 1
+                        running[executor.submit(ctx.shipa.worker(run_node), reconcile)] = key
+                    else:
+                        continue
+                    del pending[key]
+                    progress = True
+
+            if not running:
+                # only left with skipped nodes, or a dependency cycle
+                for key in pending:
+                    reports[key] = dict(status='SKIPPED', changed=False, msg='dependency cycle')
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                busy[nodes[key][0]] -= 1
+                reports[key] = future.result()
+    finally:
+        executor.shutdown()
+
+    return reports
+
+
+def run_module():
+    module_args = shipa_argument_spec()
+    module_args.update(
+        state=dict(type='dict', required=True, options=state_spec()),
+        concurrency=dict(type='dict', required=False, apply_defaults=True, options=dict(
+            frameworks=dict(type='int', default=4),
+            clusters=dict(type='int', default=4),
+            apps=dict(type='int', default=8),
+            app_resources=dict(type='int', default=8),
+            deploys=dict(type='int', default=4),
+        )),
+    )
+
+    result = dict(
+        changed=False,
+        status='',
+        shipa_state={},
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True,
+    )
+
+    duplicates = duplicate_names(module.params['state'])
+    if duplicates:
+        module.fail_json(msg='resources named more than once in state: {}'.format(', '.join(duplicates)))
+
+    shipa = Client(module, module.params['shipa_host'], module.params['shipa_token'])
+    ok, err = shipa.test_access()
+    if not ok:
+        module.fail_json(msg=err)
+
+    concurrency = dict((level, max(1, module.params['concurrency'][level])) for level in LEVELS)
+
+    started = time.time()
+    ctx = Context(shipa, module.check_mode)
+    reports = run_graph(ctx, build_graph(ctx, module.params['state']), concurrency)
+    for warning in ctx.warnings:
+        module.warn(warning)
+
+    result['shipa_state'] = reports
+    result['elapsed'] = round(time.time() - started, 3)
+    result['changed'] = any(report['changed'] for report in reports.values())
+
+    failed = sorted(key for key, report in reports.items() if report['status'] == 'FAILED')
+    if failed:
+        module.fail_json(msg='failed to reconcile: {}'.format(', '.join(failed)), **result)
+
+    result['status'] = "SUCCESS"
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,39 @@
+import io
+import os
 import re
+import ssl
+import json
+import select
+import time
+import copy
+import fcntl
+import codecs
 import base64
+import random
+import shutil
+import socket
+import hashlib
+import tempfile
+import itertools
+import threading
 from datetime import timedelta
-from ansible.module_utils.six.moves.urllib.parse import urlencode
+from email.utils import mktime_tz, parsedate_tz
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib.error import HTTPError
+from ansible.module_utils.six.moves.urllib.parse import urlencode, urlparse
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
 
-from ansible.module_utils.urls import fetch_url
+from ansible.module_utils.basic import env_fallback
+from ansible.module_utils.urls import fetch_url, open_url
+
+DEFAULT_CACHE_DIR = '~/.ansible/shipa'
+DEFAULT_AUTH_CACHE_TTL = 300
+DEFAULT_TIMEOUT = 1500
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_RETRIES = 3
+DEFAULT_CIRCUIT_THRESHOLD = 5
+MAX_RETRY_DELAY = 120
 
 regex = re.compile(
     r'^((?P<days>[\.\d]+?)d)?((?P<hours>[\.\d]+?)h)?((?P<minutes>[\.\d]+?)m)?((?P<seconds>[\.\d]+?)s)?$'
@@ -26,6 +56,14 @@ def parse_duration(duration):
     return timedelta(**time_params)
 
 
+def fingerprint(*values):
+    """ Stable sha256 hex digest of JSON serializable values """
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
 def form_urlencoded(params):
     """ Convert data into a form-urlencoded string """
     # result = [(to_text(key), to_text(value)) for key, value in params.items()]
@@ -33,11 +71,1023 @@ def form_urlencoded(params):
     return urlencode(result, doseq=True)
 
 
+STREAM_CHUNK_SIZE = 64 * 1024
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# characters that may continue a number, e.g. 1 of 1.5 or 1e3 when the chunk ends after the 1
+_JSON_NUMBER_CHARS = frozenset('0123456789+-.eE')
+
+
+def iter_json_list(chunks):
+    """
+    Decode a JSON list from byte chunks, yielding each item as soon as it is complete.
+
+    Only the item being decoded is buffered, memory stays flat however long the list is
+    and a caller that stops iterating never reads the rest. An empty or null document yields nothing.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, expect = '', 0, 'start'
+    for chunk in itertools.chain(chunks, [None]):
+        eof = chunk is None
+        buf = buf[pos:] + decoder.decode(chunk or b'', final=eof)
+        pos = 0
+        while True:
+            pos = _JSON_WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+
+            char = buf[pos]
+            if expect == 'start':
+                if buf.startswith('null', pos):
+                    return
+                if not eof and 'null'.startswith(buf[pos:]):
+                    break
+                if char != '[':
+                    raise ValueError('expected a JSON list, got {!r}'.format(buf[pos:pos + 20]))
+                pos, expect = pos + 1, 'first'
+            elif expect == 'separator' or (expect == 'first' and char == ']'):
+                if char == ']':
+                    return
+                if char != ',':
+                    raise ValueError('expected , or ] at {!r}'.format(buf[pos:pos + 20]))
+                pos, expect = pos + 1, 'item'
+            else:
+                try:
+                    item, end = _JSON_DECODER.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    break
+                if not eof and isinstance(item, (int, float)) and not isinstance(item, bool) and (
+                        end == len(buf) or buf[end] in _JSON_NUMBER_CHARS):
+                    # the number might continue in the next chunk
+                    break
+                yield item
+                pos, expect = end, 'separator'
+
+    if expect != 'start':
+        raise ValueError('truncated JSON list')
+
+
+# envs managed by the platform, never removed by exclusive env updates
+PROTECTED_ENV_PREFIXES = ('SHIPA_', 'TSURU_')
+
+
+def env_fingerprint(env):
+    """ Fingerprint of the value of an env, to tell whether a private env the API masks was changed """
+    return fingerprint(env.get('name'), str(env.get('value')))
+
+
+def env_delta(current, desired, private=False, exclusive=False, applied=None):
+    """
+    Compare the envs set on an app with the desired ones.
+
+    :param current: envs returned by GET /apps/{app}/env
+    :param desired: envs to set, a list of name/value dicts
+    :param private: whether desired envs are set as private
+    :param exclusive: whether envs missing from desired have to be removed
+    :param applied: env_fingerprint of the private envs last set on the app, by env name
+    :return dict: added and changed envs, and the names of removed envs
+
+    The API masks values of private envs, they are compared through the fingerprint of the last applied value
+    and reported as changed when it is unknown.
+    """
+    applied = applied or {}
+    existing = dict((env.get('name'), env) for env in current or [])
+    delta = dict(added=[], changed=[], removed=[])
+
+    for env in desired:
+        current_env = existing.get(env.get('name'))
+        if current_env is None:
+            delta['added'].append(env)
+        elif not current_env.get('public', True):
+            if not private or applied.get(env.get('name')) != env_fingerprint(env):
+                delta['changed'].append(env)
+        elif private or str(current_env.get('value')) != str(env.get('value')):
+            delta['changed'].append(env)
+
+    if exclusive:
+        names = set(env.get('name') for env in desired)
+        delta['removed'] = sorted(
+            name for name in existing if name not in names and not name.startswith(PROTECTED_ENV_PREFIXES)
+        )
+
+    return delta
+
+
+NETWORK_POLICY_DEFAULT_MODE = 'allow-all'
+
+
+def _canonical(value):
+    """ Drop unset values and sort lists, so that equal documents compare equal whatever the ordering """
+    if isinstance(value, dict):
+        value = dict((k, _canonical(v)) for k, v in value.items())
+        return dict((k, v) for k, v in value.items() if v not in (None, '', [], {}))
+    if isinstance(value, (list, tuple)):
+        return sorted((_canonical(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True))
+    return value
+
+
+def normalize_network_policy(policy):
+    """
+    Canonical form of the ingress and egress parts of a network policy.
+
+    Missing directions and policy modes default to allow-all, ports default to TCP,
+    rules and every list inside them are compared regardless of order.
+    """
+    normalized = {}
+    for direction in ('ingress', 'egress'):
+        config = dict((policy or {}).get(direction) or {})
+        config['policy_mode'] = config.get('policy_mode') or NETWORK_POLICY_DEFAULT_MODE
+        for key in ('custom_rules', 'shipa_rules'):
+            rules = []
+            for rule in config.get(key) or []:
+                rule = dict(rule)
+                rule['ports'] = [dict(port, protocol=port.get('protocol') or 'TCP') for port in rule.get('ports') or []]
+                rules.append(rule)
+            config[key] = rules
+        normalized[direction] = _canonical(config)
+    return normalized
+
+
+# Per resource rules used by resource_diff, paths are dotted and `*` matches every item of a list:
+#   ignore: server managed fields, never compared
+#   unordered: lists compared regardless of their order
+#   defaults: values assumed by the server when a field is not set
+#   write_only: secrets the server may or may not return, never compared and redacted from results
+DIFF_RULES = {
+    'application': dict(
+        ignore=('createdAt', 'updatedAt', 'units', 'lock', 'status'),
+        unordered=('tags', 'cname', 'teams', 'routers'),
+        defaults={},
+    ),
+    'cluster': dict(
+        ignore=('createdAt', 'updatedAt'),
+        unordered=('endpoint.addresses', 'resources.frameworks'),
+        defaults={},
+        write_only=('endpoint.caCert', 'endpoint.token'),
+    ),
+    'framework': dict(
+        ignore=('createdAt', 'updatedAt'),
+        unordered=(
+            'resources.general.access.append',
+            'resources.general.access.blacklist',
+            'resources.general.security.ignoreCves',
+            'resources.general.security.ignoreComponents',
+            'resources.general.containerPolicy.allowedHosts',
+        ),
+        defaults={'resources.general.setup.provisioner': 'kubernetes'},
+    ),
+    'job': dict(
+        ignore=('createdAt', 'updatedAt', 'status', 'active', 'succeeded', 'failed', 'startTime', 'completionTime'),
+        unordered=(),
+        defaults={},
+    ),
+}
+
+
+def _is_unset(value):
+    return value is None or value == '' or value == [] or value == {}
+
+
+def _resolve(value, path):
+    """ Yield (container, key) pairs addressed by a dotted path """
+    head, _, rest = path.partition('.')
+    if head == '*' and isinstance(value, list):
+        items = enumerate(value)
+    elif isinstance(value, dict) and head in value:
+        items = [(head, value[head])]
+    else:
+        return
+
+    for key, item in items:
+        if rest:
+            for found in _resolve(item, rest):
+                yield found
+        else:
+            yield value, key
+
+
+def _containers(value, path):
+    """ Dicts addressed by a dotted path, missing or unset dicts along the path are created """
+    if not path:
+        return [value] if isinstance(value, dict) else []
+    head, _, rest = path.partition('.')
+    if head == '*':
+        items = value if isinstance(value, list) else []
+    elif isinstance(value, dict):
+        if _is_unset(value.get(head)):
+            value[head] = {}
+        items = [value[head]]
+    else:
+        items = []
+
+    containers = []
+    for item in items:
+        containers.extend(_containers(item, rest))
+    return containers
+
+
+def normalize_resource(kind, value):
+    """ Copy of a resource state with the DIFF_RULES of its kind applied """
+    rules = DIFF_RULES.get(kind, {})
+    value = copy.deepcopy(value) if isinstance(value, dict) else {}
+
+    for path in rules.get('ignore', ()) + rules.get('write_only', ()):
+        for container, key in list(_resolve(value, path)):
+            if isinstance(container, dict):
+                del container[key]
+
+    for path, default in rules.get('defaults', {}).items():
+        parent, _, key = path.rpartition('.')
+        # a default applies whether or not its parents are set, e.g. to {general: {}}
+        for container in _containers(value, parent):
+            if _is_unset(container.get(key)):
+                container[key] = default
+
+    for path in rules.get('unordered', ()):
+        for container, key in _resolve(value, path):
+            if isinstance(container[key], list):
+                container[key] = sorted(container[key], key=lambda v: json.dumps(v, sort_keys=True))
+
+    return value
+
+
+def _compare(before, after, path, changes):
+    if isinstance(before, dict) and isinstance(after, dict):
+        for key in sorted(set(before) | set(after), key=str):
+            _compare(before.get(key), after.get(key), '{}.{}'.format(path, key) if path else str(key), changes)
+    elif isinstance(before, list) and isinstance(after, list) and len(before) == len(after):
+        for index, (b, a) in enumerate(zip(before, after)):
+            _compare(b, a, '{}.{}'.format(path, index), changes)
+    elif not (_is_unset(before) and _is_unset(after)) and before != after:
+        changes[path] = dict(before=before, after=after)
+
+
+def resource_diff(kind, before, after):
+    """
+    Field level differences between two states of a resource.
+
+    Both states are normalized with the DIFF_RULES of the kind first, unset values (None, empty strings,
+    lists and dicts) are equal to missing ones.
+
+    :return dict: dotted path -> dict(before=..., after=...), empty when nothing changed
+    """
+    changes = {}
+    _compare(normalize_resource(kind, before), normalize_resource(kind, after), '', changes)
+    return changes
+
+
+def deep_merge(current, desired):
+    """ desired merged into current, nested dicts are merged, lists and other values of desired replace current ones """
+    merged = dict(current)
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def plan_diff(kind, current, desired, merge=True):
+    """
+    Changes writing desired would make to the current state of a resource, without writing it.
+
+    :param desired: resource fields to write, in the shape the server returns them
+    :param merge: nested dicts of desired are merged into the current ones (partial update),
+                  otherwise top level fields of desired replace the current ones
+    :return dict: resource_diff changes
+    """
+    current = current if isinstance(current, dict) else {}
+    if merge:
+        planned = deep_merge(current, desired)
+    else:
+        planned = dict(current)
+        planned.update(desired)
+    return resource_diff(kind, current, planned)
+
+
+def redact_write_only(kind, value):
+    """ Copy of a resource state with the write_only fields of its kind that are set redacted, for module results """
+    value = copy.deepcopy(value)
+    for path in DIFF_RULES.get(kind, {}).get('write_only', ()):
+        for container, key in list(_resolve(value, path)):
+            if isinstance(container, dict) and not _is_unset(container[key]):
+                container[key] = REDACTED
+    return value
+
+
+def diff_output(changes):
+    """ Ansible --diff view of resource_diff changes """
+    return dict(
+        before=dict((path, change['before']) for path, change in changes.items()),
+        after=dict((path, change['after']) for path, change in changes.items()),
+    )
+
+
+def cname_scheme(encrypt):
+    return 'https' if encrypt else 'http'
+
+
+def app_cnames(app):
+    """
+    Cnames set on an application, as returned by GET /apps/{app}.
+
+    :return dict: cname -> scheme, cnames listed without a scheme are served over http
+    """
+    cnames = {}
+    for entry in (app or {}).get('cname') or []:
+        if isinstance(entry, dict):
+            name = entry.get('cname') or entry.get('name')
+            scheme = entry.get('scheme') or cname_scheme(entry.get('encrypt'))
+        else:
+            scheme, _, name = entry.rpartition('://')
+        cnames[name] = scheme or 'http'
+    return cnames
+
+
+def shipa_argument_spec():
+    """ Arguments shared by every shipa module, they are never sent to the Shipa API """
+    return dict(
+        shipa_host=dict(type='str', required=True, no_log=True),
+        shipa_token=dict(type='str', required=True, no_log=True),
+        shipa_auth_cache_ttl=dict(type='int', default=DEFAULT_AUTH_CACHE_TTL),
+        shipa_lazy_auth=dict(type='bool', default=False),
+        shipa_cache_dir=dict(type='path', required=False, fallback=(env_fallback, ['SHIPA_CACHE_DIR'])),
+        shipa_keepalive=dict(type='bool', default=True),
+        shipa_connect_timeout=dict(type='float', default=DEFAULT_CONNECT_TIMEOUT),
+        shipa_read_timeout=dict(type='float', default=DEFAULT_READ_TIMEOUT),
+        shipa_retries=dict(type='int', default=DEFAULT_RETRIES),
+        shipa_circuit_threshold=dict(type='int', default=DEFAULT_CIRCUIT_THRESHOLD),
+        shipa_trace=dict(type='bool', default=False),
+        shipa_trace_file=dict(type='path', required=False, fallback=(env_fallback, ['SHIPA_TRACE_FILE'])),
+        shipa_cassette=dict(type='path', required=False, fallback=(env_fallback, ['SHIPA_CASSETTE'])),
+        shipa_cassette_mode=dict(type='str', choices=['record', 'replay'], default='replay',
+                                 fallback=(env_fallback, ['SHIPA_CASSETTE_MODE'])),
+    )
+
+
+class ShipaError(Exception):
+    """ Failure reported by a Client used outside of a module (see ControllerModule) or in Client.worker """
+
+
+class ControllerModule:
+    """
+    Stand-in for AnsibleModule that lets controller side plugins use Client.
+
+    Failures raise ShipaError instead of exiting the process, requests the keep-alive pool does not handle,
+    e.g. through a proxy, are sent with open_url as fetch_url needs a real AnsibleModule.
+    """
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    @staticmethod
+    def from_json(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    @staticmethod
+    def jsonify(data):
+        return json.dumps(data)
+
+    def fail_json(self, msg, **kwargs):
+        raise ShipaError(msg)
+
+    def fetch_url(self, url, **kwargs):
+        """ fetch_url for the controller: (response, info), info has the same keys """
+        info = dict(url=url, status=-1)
+        try:
+            resp = open_url(url, validate_certs=self.params.get('validate_certs', True), **kwargs)
+        except HTTPError as e:
+            info.update((name.lower(), value) for name, value in (e.headers or {}).items())
+            info.update(status=e.code, msg=str(e), body=e.read())
+            return None, info
+        except Exception as e:
+            info['msg'] = 'Request failed: {}'.format(e)
+            return None, info
+        info.update((name.lower(), value) for name, value in resp.headers.items())
+        info.update(status=resp.status, msg='OK')
+        return resp, info
+
+
+class FileStore:
+    """
+    JSON document kept on disk and shared by module runs on the same host.
+
+    The store is best-effort: unreadable files are treated as empty and write failures are ignored,
+    so a broken cache never fails a task.
+    """
+
+    # serializes read-modify-write of the threads of a process, e.g. shipa_app_env bulk mode
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            data = self.load()
+            data[key] = value
+            self.save(data)
+
+    def delete(self, key):
+        with self._lock:
+            data = self.load()
+            if data.pop(key, None) is not None:
+                self.save(data)
+
+    def save(self, data):
+        directory = os.path.dirname(self.path)
+        tmp = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            # rename is atomic, concurrent forks never see a partially written file
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class StreamedResponse:
+    """ Response body read on demand, closing it early drops the connection instead of reading the rest """
+
+    def __init__(self, fp, release):
+        self.fp = fp
+        self.complete = False
+        self.size = 0
+        # trace entry of the request, its response_bytes are the bytes actually read
+        self.trace = None
+        self._release = release
+
+    def chunks(self, size=STREAM_CHUNK_SIZE, partial=False):
+        """ :param partial: yield what has arrived as soon as it does, instead of waiting for full chunks """
+        read = self.fp.read1 if partial and hasattr(self.fp, 'read1') else self.fp.read
+        while True:
+            chunk = read(size)
+            if not chunk:
+                self.complete = True
+                self.close()
+                return
+            self.size += len(chunk)
+            yield chunk
+
+    def read(self):
+        return b''.join(self.chunks())
+
+    def close(self):
+        if self.trace is not None:
+            self.trace['response_bytes'] = self.size
+        release, self._release = self._release, None
+        if release is not None:
+            release(self.complete)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections reused for the whole module run.
+
+    There is one connection per scheme/host/port and thread, http_client connections are not thread safe.
+    Connections inherited from a parent process are never reused.
+    A request failing on a reused connection is resent on a new one only for idempotent methods,
+    other requests might have reached the server before the connection broke.
+    `connects` counts the connections opened, i.e. the TCP/TLS handshakes made.
+    """
+
+    _shared = {}
+
+    # errors raised when the server already closed an idle keep-alive connection
+    STALE_CONNECTION_ERRORS = (http_client.BadStatusLine, socket.error)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    def __init__(self, validate_certs=True, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.validate_certs = validate_certs
+        self.connect_timeout = connect_timeout
+        self.connects = 0
+        self._local = threading.local()
+        self._ssl_context = None
+
+    @classmethod
+    def shared(cls, validate_certs=True):
+        """
+        Pool shared by every Client of the process.
+
+        Ansible forks a worker per task, on the controller the pool lasts as long as the task that created it.
+        """
+        pool = cls._shared.get(validate_certs)
+        if pool is None:
+            pool = cls._shared[validate_certs] = cls(validate_certs=validate_certs)
+        return pool
+
+    @staticmethod
+    def handles(url):
+        """ Requests through a proxy are left to fetch_url """
+        parsed = urlparse(url)
+        return parsed.scheme not in getproxies() or bool(proxy_bypass(parsed.hostname or ''))
+
+    def request(self, method, url, body=None, headers=None, timeout=DEFAULT_READ_TIMEOUT, stream=False):
+        """
+        :param timeout: read timeout in seconds, connecting is bounded by connect_timeout
+        :param stream: return the body as a StreamedResponse, the connection leaves the pool until it is closed
+        :return (status, body, headers): header names are lower-cased
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '{}?{}'.format(path, parsed.query)
+
+        idempotent = method in self.IDEMPOTENT_METHODS
+        while True:
+            conn, reused = self._connection(key, timeout, check_idle=not idempotent)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = self._stream(key, conn, resp) if stream else resp.read()
+            except socket.timeout:
+                self.discard(key)
+                raise
+            except self.STALE_CONNECTION_ERRORS:
+                self.discard(key)
+                if reused and idempotent:
+                    continue
+                raise
+
+            if resp.will_close and not stream:
+                self.discard(key)
+            return resp.status, data, dict((name.lower(), value) for name, value in resp.getheaders())
+
+    def _stream(self, key, conn, resp):
+        # requests made while the body is read must not pick this connection
+        self._connections().pop(key, None)
+
+        def release(complete):
+            connections = self._connections()
+            if complete and not resp.will_close and key not in connections:
+                connections[key] = conn
+            else:
+                conn.close()
+
+        return StreamedResponse(resp, release)
+
+    def discard(self, key):
+        conn = self._connections().pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        for key in list(self._connections()):
+            self.discard(key)
+
+    def _connections(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None or self._local.pid != os.getpid():
+            # sockets of a forked parent are shared with it, leave them alone
+            connections = self._local.connections = {}
+            self._local.pid = os.getpid()
+        return connections
+
+    def _connection(self, key, timeout, check_idle=False):
+        """ :param check_idle: drop a kept connection the server already closed or wrote to, it is not resent on """
+        connections = self._connections()
+        conn = connections.get(key)
+        if conn is not None and check_idle and self._closed_by_peer(conn):
+            self.discard(key)
+            conn = None
+        reused = conn is not None
+        if not reused:
+            scheme, netloc = key
+            if scheme == 'https':
+                conn = http_client.HTTPSConnection(netloc, timeout=self.connect_timeout, context=self._context())
+            else:
+                conn = http_client.HTTPConnection(netloc, timeout=self.connect_timeout)
+            conn.connect()
+            self.connects += 1
+            connections[key] = conn
+
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, reused
+
+    @staticmethod
+    def _closed_by_peer(conn):
+        # an idle keep-alive socket is readable only once the server closed it (or sent garbage)
+        if conn.sock is None:
+            return True
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+            if not self.validate_certs:
+                self._ssl_context.check_hostname = False
+                self._ssl_context.verify_mode = ssl.CERT_NONE
+        return self._ssl_context
+
+
+def deploy_status(deploy):
+    """
+    State of a deploy record returned by GET /deploys.
+
+    :return (done, succeeded): a deploy is done once it reports an error, a final status or its duration
+    """
+    if deploy.get('error') or deploy.get('Error'):
+        return True, False
+
+    status = str(deploy.get('status') or '').lower()
+    if status in ('failed', 'error', 'rollback'):
+        return True, False
+    if status in ('success', 'succeeded', 'finished', 'done'):
+        return True, True
+
+    return bool(deploy.get('duration') or deploy.get('Duration')), True
+
+
+def deploy_error(app, deploy):
+    """ Failure message of a failed deploy record, or of the error met while polling it """
+    if not isinstance(deploy, dict):
+        return 'failed to poll deploy of {}: {}'.format(app, deploy)
+    reason = deploy.get('error') or deploy.get('Error') or 'status {}'.format(deploy.get('status') or 'unknown')
+    return 'deploy of {} failed: {}'.format(app, reason)
+
+
+def deploy_id(deploy):
+    return deploy.get('id') or deploy.get('ID') if deploy else None
+
+
+def job_counts(job):
+    """ Active, succeeded and failed pods of a job, top level or under a Kubernetes style status """
+    counters = job.get('status') if isinstance(job.get('status'), dict) else job
+    return dict((key, counters.get(key) or 0) for key in ('active', 'succeeded', 'failed'))
+
+
+def job_status(job):
+    """
+    State of a job record returned by GET /jobs.
+
+    :return (done, succeeded): a job is done once a Complete or Failed condition is set, it reached its completions
+        or failed more than backoffLimit times
+    """
+    status = job.get('status')
+    counters = status if isinstance(status, dict) else job
+    for condition in counters.get('conditions') or []:
+        if str(condition.get('status')).lower() == 'true' and condition.get('type') in ('Complete', 'Failed'):
+            return True, condition.get('type') == 'Complete'
+
+    state = '' if isinstance(status, dict) else str(status or '').lower()
+    if state in ('failed', 'error'):
+        return True, False
+    if state in ('succeeded', 'success', 'complete', 'completed'):
+        return True, True
+
+    counts = job_counts(job)
+    if counts['succeeded'] >= (job.get('completions') or 1):
+        return True, True
+    if job.get('backoffLimit') is not None and counts['failed'] > job['backoffLimit']:
+        return True, False
+    return False, False
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the Shipa API is down.
+
+    Consecutive failed requests are counted per host in a FileStore shared by every module run on the same host.
+    After `threshold` of them requests are refused for `reset_after` seconds, then let through again,
+    a single success closes the circuit. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, store, key, threshold=DEFAULT_CIRCUIT_THRESHOLD, reset_after=30):
+        self.store = store
+        self.key = key
+        self.threshold = threshold
+        self.reset_after = reset_after
+
+    def open_until(self):
+        if not self.threshold:
+            return 0
+        return (self.store.get(self.key) or {}).get('open_until', 0)
+
+    def record(self, failed):
+        if not self.threshold:
+            return
+
+        state = self.store.get(self.key) or {}
+        if not failed:
+            if state:
+                self.store.delete(self.key)
+            return
+
+        state = {'failures': state.get('failures', 0) + 1}
+        if state['failures'] >= self.threshold:
+            state['open_until'] = time.time() + self.reset_after
+        self.store.set(self.key, state)
+
+
+def retry_after(headers):
+    """ Seconds to wait according to a Retry-After header, in seconds or as an HTTP date """
+    value = (headers or {}).get('retry-after')
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        return max(0.0, mktime_tz(parsed) - time.time()) if parsed else 0
+
+
+# payload keys never written to a cassette
+REDACTED_KEYS = ('token', 'caCert', 'password', 'secret')
+REDACTED = '<redacted>'
+
+
+class Cassette:
+    """
+    API interactions of a play recorded to a JSONL file, one line per request.
+
+    Recording appends the requests of every task with secrets redacted and the host replaced by a placeholder.
+    Replay serves each task the interactions recorded by the task at the same position in the play, in any
+    order within the task as some modules send requests concurrently. A request that was not recorded,
+    or recorded requests the task did not send, fail the task: the API calls made by the play changed.
+
+    The position in the play is kept in <cassette>.cursor, it starts over once the last task was replayed.
+    Tasks are numbered in the order they first write to the cassette, under a lock of the file, so tasks
+    recorded in parallel forks get distinct numbers, but their order, hence replay, is only stable with one fork.
+    Both modes keep the module caches in <cassette>.cache, emptied when a recording or a replay starts,
+    so the same calls are made whatever the state of the machine.
+    """
+
+    def __init__(self, path, mode, host, token):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.mode = mode
+        self.host = host
+        # an empty token would be "found" everywhere
+        self.token = token or REDACTED
+        self.cache_dir = self.path + '.cache'
+        self._cursor = FileStore(self.path + '.cursor')
+        self._lock = threading.Lock()
+        self._task = None
+        self._pending = None
+        self._tasks = 0
+        self._finished = False
+
+        starting = not os.path.exists(self.path) if mode == 'record' else self._cursor.get('task') is None
+        if starting:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def record(self, method, url, data, status, body, headers):
+        """ :return body: readable again, streamed bodies are read to be recorded """
+        streamed = isinstance(body, StreamedResponse)
+        raw = body.read() if streamed else body
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+
+        interaction = dict(
+            method=method,
+            url=self._url(url),
+            request=self._redact(data),
+            status=status,
+            headers=dict((key, value) for key, value in (headers or {}).items() if key == 'retry-after'),
+            body=self._redact_body(raw or b''),
+        )
+        with self._lock, open(self.path, 'a') as f:
+            # other forks record too, the lock is released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if self._task is None:
+                self._task = self._recorded_tasks()
+            interaction['task'] = self._task
+            f.write(json.dumps(interaction, sort_keys=True) + '\n')
+
+        if streamed:
+            return StreamedResponse(io.BytesIO(raw), lambda complete: None)
+        return raw
+
+    def replay(self, method, url, data, stream=False):
+        """ :return (status, body, headers): status is None when the request was not recorded for this task """
+        url, request = self._url(url), self._redact(data)
+        with self._lock:
+            if self._pending is None:
+                self._load()
+            for index, interaction in enumerate(self._pending):
+                if (interaction['method'], interaction['url'], interaction['request']) == (method, url, request):
+                    del self._pending[index]
+                    break
+            else:
+                return None, 'request {} {} was not recorded for task #{} in {}'.format(
+                    method, url, self._task, self.path), {}
+
+        raw = interaction['body'].encode('utf-8')
+        if stream and interaction['status'] == HTTPStatus.OK:
+            raw = StreamedResponse(io.BytesIO(raw), lambda complete: None)
+        return interaction['status'], raw, interaction['headers']
+
+    def finish(self):
+        """
+        End the task, moving the replay cursor to the next one.
+
+        :return str: error when recorded requests were not sent
+        """
+        with self._lock:
+            if not self.replaying or self._pending is None or self._finished:
+                return None
+            self._finished = True
+            following = self._task + 1
+            if following < self._tasks:
+                self._cursor.set('task', following)
+            else:
+                self._cursor.delete('task')
+
+            if self._pending:
+                missing = ', '.join('{} {}'.format(i['method'], i['url']) for i in self._pending)
+                return 'recorded requests of task #{} in {} were not sent: {}'.format(self._task, self.path, missing)
+        return None
+
+    def _load(self):
+        self._task = self._cursor.get('task', 0)
+        self._pending = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    interaction = json.loads(line)
+                    self._tasks = max(self._tasks, interaction['task'] + 1)
+                    if interaction['task'] == self._task:
+                        self._pending.append(interaction)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _recorded_tasks(self):
+        tasks = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    tasks = max(tasks, json.loads(line)['task'] + 1)
+        except (IOError, OSError, ValueError):
+            pass
+        return tasks
+
+    def _url(self, url):
+        return url.replace(self.host, '{host}', 1)
+
+    def _redact(self, data):
+        if not data:
+            return None
+        try:
+            document = json.loads(data)
+        except ValueError:
+            return data.replace(self.token, REDACTED)
+        return self._redact_document(document)
+
+    def _redact_body(self, raw):
+        text = raw.decode('utf-8', 'replace')
+        try:
+            document = json.loads(text)
+        except ValueError:
+            return text.replace(self.token, REDACTED)
+        return json.dumps(self._redact_document(document))
+
+    def _redact_document(self, document):
+        if isinstance(document, dict):
+            return dict(
+                (key, REDACTED if key in REDACTED_KEYS and value else self._redact_document(value))
+                for key, value in document.items()
+            )
+        if isinstance(document, list):
+            return [self._redact_document(value) for value in document]
+        if isinstance(document, str) and self.token in document:
+            return document.replace(self.token, REDACTED)
+        return document
+
+
 class HTTPStatus:
     OK = 200
     CREATED = 201
     ACCEPTED = 202
     BAD_REQUEST = 400
+    UNAUTHORIZED = 401
+    NOT_FOUND = 404
+    METHOD_NOT_ALLOWED = 405
+    TOO_MANY_REQUESTS = 429
+    INTERNAL_SERVER_ERROR = 500
+    BAD_GATEWAY = 502
+    SERVICE_UNAVAILABLE = 503
+    GATEWAY_TIMEOUT = 504
+
+
+_UNDECODED = object()
+
+
+def _error_message(document):
+    """ Message of a Shipa error document, e.g. {"Error": "..."} or {"error": {"message": "..."}} """
+    if not isinstance(document, dict):
+        return None
+    for key in ('Error', 'error'):
+        error = document.get(key)
+        if isinstance(error, dict):
+            error = error.get('message') or error.get('Message') or json.dumps(error, sort_keys=True)
+        if error:
+            return str(error)
+    return None
+
+
+class Response:
+    """
+    A Shipa API response, its body is decoded on first use.
+
+    Some calls report failures with a 2xx status and an error document, streamed calls like deploys
+    write one JSON document per line. `error` only decodes bodies that mention an error key at all
+    and looks at the top level of each document, so a resource named "error" is not a failure.
+    """
+
+    __slots__ = ('status', 'raw', '_json', '_error')
+
+    def __init__(self, status, raw):
+        self.status = status
+        self.raw = raw.encode('utf-8') if isinstance(raw, str) else (raw or b'')
+        self._json = _UNDECODED
+        self._error = _UNDECODED
+
+    @property
+    def text(self):
+        return self.raw.decode('utf-8', 'replace')
+
+    @property
+    def json(self):
+        """ Decoded body, None when it is not a single JSON document """
+        if self._json is _UNDECODED:
+            try:
+                self._json = json.loads(self.text) if self.raw.strip() else None
+            except ValueError:
+                self._json = None
+        return self._json
+
+    @property
+    def data(self):
+        """ Decoded body, or its text when it is not JSON, for module results """
+        document = self.json
+        return self.text if document is None else document
+
+    @property
+    def error(self):
+        """ Error reported by the server, None if there is none """
+        if self._error is _UNDECODED:
+            self._error = self._find_error()
+        return self._error
+
+    @property
+    def message(self):
+        """ Error or, when there is none, the body as text, suitable for fail_json """
+        return self.error or self.text
+
+    def _find_error(self):
+        failed = self.status >= HTTPStatus.BAD_REQUEST
+        if not failed and b'rror"' not in self.raw:
+            return None
+
+        document = self.json
+        if document is not None:
+            documents = [document]
+        else:
+            documents = []
+            for line in self.raw.splitlines():
+                try:
+                    documents.append(json.loads(line.decode('utf-8', 'replace')))
+                except ValueError:
+                    pass
+
+        for document in documents:
+            message = _error_message(document)
+            if message:
+                return message
+        if failed:
+            return self.text.strip() or 'shipa API returned {}'.format(self.status)
+        return None
+
+    def __repr__(self):
+        return 'Response({}, {} bytes)'.format(self.status, len(self.raw))
 
 
 class Endpoint:
@@ -46,6 +1096,8 @@ class Endpoint:
     APPLICATION = 'apps'
     CLUSTER = 'provisioner/clusters'
     JOB = 'jobs'
+    DEPLOY = 'deploys'
+    ENDPOINTS = (CLUSTER, FRAMEWORK, APPLICATION, DEPLOY, PLAN, JOB)
 
     def __init__(self, host):
         self.host = host
@@ -68,6 +1120,12 @@ class Endpoint:
     def app_deploy(self, app):
         return '{}/deploy'.format(self._url(self.APPLICATION, app))
 
+    def deploys(self, app, limit=None):
+        params = {'app': app}
+        if limit:
+            params['limit'] = limit
+        return '{}?{}'.format(self._url(self.DEPLOY), form_urlencoded(params))
+
     def app_cname(self, app):
         return '{}/cname'.format(self._url(self.APPLICATION, app))
 
@@ -77,6 +1135,19 @@ class Endpoint:
     def network_policy(self, app):
         return '{}/network-policy'.format(self._url(self.APPLICATION, app))
 
+    def template(self, url):
+        """ Endpoint of a URL with the resource name replaced, e.g. apps/{name}/env """
+        path = urlparse(url).path.strip('/')
+        prefix = urlparse(self.host).path.strip('/')
+        if prefix and path.startswith(prefix):
+            path = path[len(prefix):].strip('/')
+
+        for endpoint in self.ENDPOINTS:
+            if path == endpoint or path.startswith(endpoint + '/'):
+                rest = path[len(endpoint) + 1:].split('/') if path != endpoint else []
+                return '/'.join([endpoint, '{name}'] + rest[1:]) if rest else endpoint
+        return path
+
     def _url(self, endpoint, resource_name=None):
         url = '{}/{}'.format(self.host, endpoint)
         if resource_name:
@@ -85,26 +1156,121 @@ class Endpoint:
 
 
 class Client:
+    AUTH_FAILED = 'shipa client auth failed'
+
+    IDEMPOTENT_METHODS = ConnectionPool.IDEMPOTENT_METHODS
+    RETRY_STATUSES = (
+        HTTPStatus.TOO_MANY_REQUESTS,
+        HTTPStatus.INTERNAL_SERVER_ERROR,
+        HTTPStatus.BAD_GATEWAY,
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        HTTPStatus.GATEWAY_TIMEOUT,
+    )
+
     def __init__(self, module, host, token):
         self.module = module
         self.token = token
         self._resource = Endpoint(host)
 
+        params = getattr(module, 'params', None) or {}
+        self._lazy_auth = params.get('shipa_lazy_auth', False)
+        self._auth_ttl = params.get('shipa_auth_cache_ttl')
+        if self._auth_ttl is None:
+            self._auth_ttl = DEFAULT_AUTH_CACHE_TTL
+        cache_dir = params.get('shipa_cache_dir') or DEFAULT_CACHE_DIR
+
+        self._cassette = None
+        if params.get('shipa_cassette'):
+            self._cassette = Cassette(params['shipa_cassette'], params.get('shipa_cassette_mode') or 'replay', host, token)
+            cache_dir = self._cassette.cache_dir
+            if self._auth_ttl > 0:
+                # an expiring probe would make recording and replay send different requests
+                self._auth_ttl = float('inf')
+        self._auth_cache = FileStore(os.path.join(cache_dir, 'auth.json'))
+        self._auth_key = hashlib.sha256('{}\n{}'.format(host, token).encode('utf-8')).hexdigest()
+        # API features detected on this host, e.g. whether GET /jobs/{name} is served
+        self._features = FileStore(os.path.join(cache_dir, 'features.json'))
+        self._features_key = hashlib.sha256(host.encode('utf-8')).hexdigest()
+        # fingerprints of what was last applied to this host, see get_fingerprint
+        self._fingerprints = FileStore(os.path.join(cache_dir, 'fingerprints.json'))
+
+        self._connect_timeout = params.get('shipa_connect_timeout') or DEFAULT_CONNECT_TIMEOUT
+        self._read_timeout = params.get('shipa_read_timeout') or DEFAULT_READ_TIMEOUT
+        self._retries = params.get('shipa_retries')
+        if self._retries is None:
+            self._retries = DEFAULT_RETRIES
+        threshold = params.get('shipa_circuit_threshold')
+        if threshold is None:
+            threshold = DEFAULT_CIRCUIT_THRESHOLD
+        self._breaker = CircuitBreaker(FileStore(os.path.join(cache_dir, 'circuit.json')), self._features_key, threshold)
+
+        self._pool = None
+        if params.get('shipa_keepalive', True):
+            self._pool = ConnectionPool.shared(validate_certs=params.get('validate_certs', True))
+            self._pool.connect_timeout = self._connect_timeout
+
+        # per thread state, see worker
+        self._local = threading.local()
+
+        # name -> job for every job seen during this module run
+        self._job_index = {}
+        self._job_index_complete = False
+
+        # requests made by this client, returned as shipa_trace when tracing is enabled
+        self._trace = None
+        self._trace_file = params.get('shipa_trace_file')
+        if params.get('shipa_trace') or self._trace_file:
+            self._trace = []
+        if self._trace is not None or self._cassette is not None:
+            self._wrap_exit()
+
     def test_access(self):
+        """
+        Verify credentials with a GET /plans probe.
+
+        A successful probe is remembered for shipa_auth_cache_ttl seconds, keyed by a hash of host and token,
+        so following tasks skip it. With shipa_lazy_auth the probe is skipped and a 401 on the first real call
+        fails the task instead.
+        """
+        if self._lazy_auth:
+            return True, ''
+
+        if self._auth_ttl > 0:
+            expires_at = self._auth_cache.get(self._auth_key, 0)
+            if expires_at > time.time():
+                return True, ''
+
         ok, _ = self._get(self._resource.plan())
-        return ok, '' if ok else 'shipa client auth failed'
+        if ok and self._auth_ttl > 0:
+            self._auth_cache.set(self._auth_key, time.time() + self._auth_ttl)
+        return ok, '' if ok else self.AUTH_FAILED
+
+    @staticmethod
+    def written_resource(resp, name, name_keys=('name',)):
+        """
+        Resource returned by a create or update call.
+
+        :return dict: the resource, None when the response body does not hold the named resource
+        """
+        resource = resp.json
+        if isinstance(resource, dict) and any(resource.get(key) == name for key in name_keys):
+            return resource
+        return None
+
+    def list_frameworks(self):
+        return self._get(self._resource.framework())
 
     def get_framework(self, name):
         return self._get(self._resource.framework(name))
 
     def create_framework(self, name, resources=None):
-        return self._post(self._resource.framework(), self._prepare_framework_payload(name, resources))
+        return self._post(self._resource.framework(), self.prepare_framework_payload(name, resources))
 
     def update_framework(self, name, resources=None):
-        return self._put(self._resource.framework(), self._prepare_framework_payload(name, resources))
+        return self._put(self._resource.framework(), self.prepare_framework_payload(name, resources))
 
     @staticmethod
-    def _prepare_framework_payload(name, resources=None):
+    def prepare_framework_payload(name, resources=None):
         if not resources:
             resources = {
                 "general": {
@@ -119,18 +1285,35 @@ class Client:
             "resources": resources
         }
 
+    def list_applications(self):
+        return self._get(self._resource.application())
+
     def get_application(self, name):
         return self._get(self._resource.application(name))
 
     def create_application(self, app):
         return self._post(self._resource.application(), app)
 
+    @staticmethod
+    def application_state(app):
+        """ Application payload in the shape returned by GET /apps/{name} """
+        return {
+            'name': app.get('name'),
+            'pool': app.get('pool'),
+            'teamowner': app.get('teamOwner'),
+            'plan': {'name': app.get('plan')},
+            'tags': app.get('tags'),
+        }
+
     def update_application(self, name, app):
         payload = {
             key: app.get(key) for key in ('pool', 'teamOwner', 'plan', 'tags')
         }
         return self._put(self._resource.application(name), payload)
 
+    def list_clusters(self):
+        return self._get(self._resource.cluster())
+
     def get_cluster(self, name):
         return self._get(self._resource.cluster(name))
 
@@ -140,20 +1323,146 @@ class Client:
     def update_cluster(self, name, payload):
         return self._put(self._resource.cluster(name), payload)
 
-    def deploy_app(self, req):
+    @staticmethod
+    def prepare_cluster_payload(name, endpoint, resources):
+        """ caCert and token of the endpoint may be given as paths to files holding them """
+        endpoint = dict(endpoint or {})
+        for key in ('caCert', 'token'):
+            value = endpoint.get(key)
+            if value and os.path.exists(value):
+                with open(value) as f:
+                    endpoint[key] = f.read().strip(' \n')
+
+        return {
+            'name': name,
+            'endpoint': endpoint,
+            'resources': resources,
+        }
+
+    def get_fingerprint(self, kind, name):
+        """ Fingerprint recorded by set_fingerprint for a resource of this Shipa host, None if unknown """
+        return self._fingerprints.get(self._fingerprint_key(kind, name))
+
+    def set_fingerprint(self, kind, name, value):
+        self._fingerprints.set(self._fingerprint_key(kind, name), value)
+
+    def _fingerprint_key(self, kind, name):
+        return '{}:{}/{}'.format(self._features_key, kind, name)
+
+    @staticmethod
+    def prepare_deploy_request(params):
+        """ Build a deploy request from shipa_app_deploy options """
+        keys = ('app', 'image', 'appConfig', 'canarySettings', 'podAutoScaler', 'port', 'registry', 'volumes')
+        req = {
+            key: params.get(key) for key in keys
+        }
+
+        if req.get('port') and req['port'].get('protocol', '') == '':
+            req['port'] = dict(req['port'], protocol='TCP')
+
+        if req.get('volumes'):
+            volumes = []
+            for v in req.get('volumes'):
+                vol = {
+                    'volumeName': v.get('name'),
+                    'volumeMountPath': v.get('mountPath'),
+                }
+                if v.get('mountOptions'):
+                    vol['volumeMountOptions'] = v.get('mountOptions')
+                volumes.append(vol)
+            req['volumesToBind'] = volumes
+            del req['volumes']
+
+        return req
+
+    def deploy_app(self, req, timeout=DEFAULT_TIMEOUT):
+        ok, _, body = self.submit_deploy(req, timeout)
+        return ok, body
+
+    def submit_deploy(self, req, timeout=DEFAULT_TIMEOUT):
+        """
+        Start a deploy.
+
+        :param timeout: seconds the deploy may take, output the server streams while deploying is read until then
+        :return (ok, pending, body): pending is set when the server accepted the deploy without waiting for it,
+            ok is None when timeout expired while the deploy output was read, body is the output read so far
+        """
+        deadline = time.time() + timeout
         url = self._resource.app_deploy(req['app'])
-        status_code, body = self._raw_request('POST', url, req)
-        ok = status_code in (HTTPStatus.OK, HTTPStatus.CREATED, HTTPStatus.ACCEPTED)
-        if 'There are vulnerabilities!' in str(body):
+        status_code, body = self._raw_request('POST', url, req, timeout=timeout, stream=True)
+        if isinstance(body, StreamedResponse):
+            output = []
+            try:
+                for chunk in body.chunks(partial=True):
+                    output.append(chunk)
+                    if time.time() >= deadline:
+                        return None, False, Response(status_code, b''.join(output))
+            except (http_client.HTTPException, socket.error) as e:
+                if time.time() >= deadline:
+                    return None, False, Response(status_code, b''.join(output))
+                self._fail('shipa request POST {} failed: {}'.format(url, e))
+            finally:
+                # an unfinished body drops the connection, the deploy goes on server side
+                body.close()
+            body = b''.join(output)
+
+        resp = Response(status_code, body)
+        ok = status_code in (HTTPStatus.OK, HTTPStatus.CREATED, HTTPStatus.ACCEPTED) and resp.error is None
+        if b'There are vulnerabilities!' in resp.raw:
             ok = False
-        return ok, body
+        return ok, ok and status_code == HTTPStatus.ACCEPTED, resp
+
+    def last_deploy(self, app):
+        """ :return (ok, deploy): ok is None, with the error message, when the server does not serve GET /deploys """
+        ok, resp = self._get(self._resource.deploys(app, limit=1))
+        if resp.status in (HTTPStatus.NOT_FOUND, HTTPStatus.METHOD_NOT_ALLOWED):
+            return None, resp.message
+        if not ok:
+            return False, resp.message
+        deploys = resp.json
+        return True, deploys[0] if deploys else None
+
+    def wait_for_deploy(self, app, previous_id, timeout, interval=2, max_interval=30):
+        """
+        Poll the latest deploy of app until it is done, backing off exponentially between polls.
+
+        :param previous_id: id of the latest deploy before this one was submitted
+        :param timeout: seconds to wait
+        :return (ok, deploy): deploy is None when timeout expired before the deploy was done,
+            the error message when polling failed. ok is None when the server does not serve GET /deploys.
+        """
+        deadline = time.time() + timeout
+        while True:
+            ok, deploy = self.last_deploy(app)
+            if not ok:
+                return ok, deploy
+            if deploy and deploy_id(deploy) != previous_id:
+                done, succeeded = deploy_status(deploy)
+                if done:
+                    return succeeded, deploy
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False, None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
 
     def create_app_cname(self, req):
         return self._post(self._resource.app_cname(req['app']), req)
 
+    def delete_app_cname(self, app, cnames):
+        return self._delete('{}?{}'.format(self._resource.app_cname(app), form_urlencoded({'cname': cnames})))
+
+    def get_app_env(self, app):
+        return self._get(self._resource.app_env(app))
+
     def create_app_env(self, req):
         return self._post(self._resource.app_env(req['app']), req)
 
+    def delete_app_env(self, app, names, norestart=False):
+        query = form_urlencoded({'env': names, 'norestart': str(bool(norestart)).lower()})
+        return self._delete('{}?{}'.format(self._resource.app_env(app), query))
+
     def create_network_policy(self, req):
         return self._put(self._resource.network_policy(req['app']), req)
 
@@ -161,19 +1470,210 @@ class Client:
         return self._get(self._resource.network_policy(app))
 
     def create_job(self, req):
-        return self._post(self._resource.job(), req)
+        ok, resp = self._post(self._resource.job(), req)
+        # the new job is not indexed yet, next get_job has to ask the server
+        self._job_index.pop(req.get('name'), None)
+        self._job_index_complete = False
+        return ok, resp
+
+    def list_jobs(self):
+        ok, resp = self._get(self._resource.job())
+        if ok:
+            for job in resp.json or []:
+                self._job_index[job.get('name')] = job
+            self._job_index_complete = True
+        return ok, resp
 
     def get_job(self, name):
-        ok, jobs = self._get(self._resource.job())
-        if not ok:
+        """
+        Find a job by name.
+
+        :return (found, job): the decoded job, None when it was not found
+
+        Jobs already seen in this module run are served from the in-memory index. Otherwise the job is read
+        directly from /jobs/{name}. A 404 from that route is only trusted once the host has been seen serving it,
+        until then, and on servers without the route, the job list is scanned instead.
+        """
+        job = self._job_index.get(name)
+        if job is not None:
+            return True, job
+        if self._job_index_complete:
             return False, None
 
-        for job in jobs:
-            if job['name'] == name:
+        feature = '{}:job_by_name'.format(self._features_key)
+        status_code, body = self._raw_request('GET', self._resource.job(name))
+        if status_code == HTTPStatus.NOT_FOUND and self._features.get(feature):
+            return False, None
+        if status_code == HTTPStatus.OK:
+            job = Response(status_code, body).json
+            if isinstance(job, dict) and job.get('name') == name:
+                if not self._features.get(feature):
+                    self._features.set(feature, True)
+                self._job_index[name] = job
+                return True, job
+
+        for job in self.iter_jobs():
+            if job.get('name') == name:
                 return True, job
 
         return False, None
 
+    def iter_jobs(self, page_size=None):
+        """
+        Yield jobs one by one and index them by name.
+
+        Jobs are decoded while the list is downloaded, stopping the iteration stops the download.
+        With page_size the list is requested page by page using limit/offset query parameters,
+        so the caller can stop as soon as it found what it was looking for.
+        """
+        offset = 0
+        while True:
+            url = self._resource.job()
+            if page_size:
+                url = '{}?{}'.format(url, form_urlencoded({'limit': page_size, 'offset': offset}))
+
+            ok, jobs = self._iter_list(url)
+            if not ok:
+                return
+
+            count = 0
+            for job in jobs:
+                count += 1
+                self._job_index[job.get('name')] = job
+                yield job
+
+            # a short page is the last one, a long one means the server ignored paging parameters
+            if not page_size or count != page_size:
+                break
+            offset += page_size
+
+        self._job_index_complete = True
+
+    def wait_for_jobs(self, names, timeout, interval=2, max_interval=30):
+        """
+        Poll jobs until all of them are done, backing off exponentially between polls.
+
+        A single job is read by name on hosts serving /jobs/{name}. Otherwise each poll is one list call
+        for all pending jobs, decoded as it arrives and stopped once every pending job was seen.
+
+        :param timeout: seconds to wait
+        :return (done, jobs): jobs maps names to their last known state, done is False when timeout expired first
+        """
+        deadline = time.time() + timeout
+        pending = set(names)
+        jobs = {}
+        while True:
+            for job in self._poll_jobs(pending):
+                jobs[job.get('name')] = job
+                if job_status(job)[0]:
+                    pending.discard(job.get('name'))
+            if not pending:
+                return True, jobs
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False, jobs
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+    def _poll_jobs(self, names):
+        """ Fresh state of the named jobs, the index might hold states from before they ran """
+        if len(names) == 1 and self._features.get('{}:job_by_name'.format(self._features_key)):
+            name = next(iter(names))
+            ok, resp = self._get(self._resource.job(name))
+            if not ok or not isinstance(resp.json, dict):
+                return []
+            self._job_index[name] = resp.json
+            return [resp.json]
+
+        found = []
+        jobs = self.iter_jobs()
+        for job in jobs:
+            if job.get('name') in names:
+                found.append(job)
+                if len(found) == len(names):
+                    # the rest of the list is not downloaded
+                    jobs.close()
+                    break
+        return found
+
+    def worker(self, fn):
+        """
+        Wrap fn to run in a worker thread.
+
+        Client failures in fn, e.g. auth, connection errors or an open circuit, raise ShipaError
+        instead of failing the module: only the main thread may end the module run.
+        """
+        def run(*args, **kwargs):
+            self._local.worker = True
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.worker = False
+        return run
+
+    def _fail(self, msg):
+        if getattr(self._local, 'worker', False):
+            raise ShipaError(msg)
+        self.module.fail_json(msg=msg)
+
+    def _wrap_exit(self):
+        """
+        Hook the end of the module run.
+
+        Every result gets the trace, also appended to shipa_trace_file, and a replayed task
+        fails when it did not send all the requests recorded for it.
+        """
+        exit_json, fail_json = self.module.exit_json, self.module.fail_json
+
+        def finish(kwargs):
+            error = self._cassette.finish() if self._cassette is not None else None
+            if self._trace is not None:
+                kwargs['shipa_trace'] = list(self._trace)
+                if self._trace_file:
+                    self._write_trace(kwargs['shipa_trace'])
+            return error
+
+        def finished_exit_json(**kwargs):
+            error = finish(kwargs)
+            if error:
+                kwargs.pop('msg', None)
+                return fail_json(msg=error, **kwargs)
+            return exit_json(**kwargs)
+
+        def finished_fail_json(*args, **kwargs):
+            finish(kwargs)
+            return fail_json(*args, **kwargs)
+
+        self.module.exit_json = finished_exit_json
+        self.module.fail_json = finished_fail_json
+
+    def _write_trace(self, trace):
+        task = dict(module=getattr(self.module, '_name', None), pid=os.getpid())
+        try:
+            with open(os.path.expanduser(self._trace_file), 'a') as f:
+                for entry in trace:
+                    f.write(json.dumps(dict(task, **entry), sort_keys=True) + '\n')
+        except (IOError, OSError):
+            # tracing never fails the task
+            pass
+
+    def _record(self, method, url, status_code, started, attempts, data, body):
+        if self._trace is None:
+            return None
+        entry = dict(
+            time=round(started, 3),
+            method=method,
+            endpoint=self._resource.template(url),
+            status=status_code,
+            elapsed=round(time.time() - started, 4),
+            attempts=attempts,
+            request_bytes=len(data or ''),
+            response_bytes=len(body) if isinstance(body, (bytes, str)) else None,
+        )
+        self._trace.append(entry)
+        return entry
+
     def _headers(self):
         return {
             'Accept': 'application/json',
@@ -181,28 +1681,138 @@ class Client:
             'Authorization': 'Bearer {}'.format(self.token),
         }
 
+    @staticmethod
+    def _response(status_code, body, *expected):
+        """ :return (ok, resp): ok for an expected status without an error document """
+        resp = Response(status_code, body)
+        return status_code in expected and resp.error is None, resp
+
     def _get(self, url):
         status_code, body = self._raw_request('GET', url)
-        return status_code == HTTPStatus.OK, self.module.from_json(body)
+        return self._response(status_code, body, HTTPStatus.OK)
+
+    def _iter_list(self, url):
+        """
+        GET a list endpoint and decode its items as the response arrives.
+
+        :return (ok, items): items is a generator on success, the error Response otherwise.
+            Closing the generator before its end drops the connection rather than reading the rest of the list.
+        """
+        status_code, body = self._raw_request('GET', url, stream=True)
+        if status_code != HTTPStatus.OK:
+            return False, Response(status_code, body)
+        return True, self._decode_list(body)
+
+    @staticmethod
+    def _decode_list(resp):
+        try:
+            for item in iter_json_list(resp.chunks()):
+                yield item
+        finally:
+            resp.close()
 
     def _post(self, url, payload):
         status_code, body = self._raw_request('POST', url, payload)
-        return status_code in (HTTPStatus.OK, HTTPStatus.CREATED), body
+        return self._response(status_code, body, HTTPStatus.OK, HTTPStatus.CREATED)
 
     def _put(self, url, payload):
         status_code, body = self._raw_request('PUT', url, payload)
-        return status_code == HTTPStatus.OK, body
+        return self._response(status_code, body, HTTPStatus.OK)
+
+    def _delete(self, url):
+        status_code, body = self._raw_request('DELETE', url)
+        return self._response(status_code, body, HTTPStatus.OK)
+
+    def _raw_request(self, method, url, payload=None, timeout=None, stream=False):
+        """
+        Send a request, retrying failures with jittered exponential backoff.
+
+        Idempotent methods are retried on connection errors and on 429/5xx responses,
+        other methods only on 429 as the server did not process them. Retry-After is honoured.
+        With stream the body of a 200 response is returned unread as a StreamedResponse.
+        """
+        headers = self._headers()
+        data = self.module.jsonify(payload) if payload else None
+        timeout = timeout or self._read_timeout
+
+        started = time.time()
+        attempt = 0
+        while True:
+            open_until = self._breaker.open_until()
+            if open_until > time.time():
+                self._fail('shipa API {} is failing, not retrying for {:.0f}s'.format(
+                    self._resource.host, open_until - time.time()))
 
-    def _raw_request(self, method, url, payload=None):
+            status_code, body, resp_headers = self._exchange(method, url, data, headers, timeout, stream)
+            failed = status_code is None or status_code in self.RETRY_STATUSES
+            retryable = failed and (method in self.IDEMPOTENT_METHODS or status_code == HTTPStatus.TOO_MANY_REQUESTS)
+            if not retryable or attempt >= self._retries:
+                break
+
+            if self._cassette is None or not self._cassette.replaying:
+                delay = random.uniform(0, min(2 ** attempt, MAX_RETRY_DELAY))
+                time.sleep(min(max(delay, retry_after(resp_headers)), MAX_RETRY_DELAY))
+            attempt += 1
+
+        if status_code != HTTPStatus.TOO_MANY_REQUESTS:
+            # a request counts once whatever its attempts, throttling says nothing about the health of the API
+            self._breaker.record(failed)
+        entry = self._record(method, url, status_code, started, attempt + 1, data, body)
+        if entry is not None and isinstance(body, StreamedResponse):
+            body.trace = entry
+        if status_code is None:
+            self._fail('shipa request {} {} failed: {}'.format(method, url, body))
+        if status_code == HTTPStatus.UNAUTHORIZED:
+            # cached credentials might have been revoked since the last probe
+            self._auth_cache.delete(self._auth_key)
+            self._fail(self.AUTH_FAILED)
+        return status_code, body
+
+    def _exchange(self, method, url, data, headers, timeout, stream=False):
+        """ Send the request, or with a cassette record it or serve it from the recording """
+        cassette = self._cassette
+        if cassette is not None and cassette.replaying:
+            status_code, body, resp_headers = cassette.replay(method, url, data, stream)
+            if status_code is None:
+                self._fail(body)
+            return status_code, body, resp_headers
+
+        status_code, body, resp_headers = self._send(method, url, data, headers, timeout, stream)
+        if cassette is not None and status_code is not None:
+            body = cassette.record(method, url, data, status_code, body, resp_headers)
+        return status_code, body, resp_headers
+
+    def _send(self, method, url, data, headers, timeout, stream=False):
+        """ :return (status, body, headers): status is None and body the error when the request failed """
+        if self._pool is None or not self._pool.handles(url):
+            return self._fetch(method, url, data, headers, timeout, stream)
+
+        try:
+            status_code, body, resp_headers = self._pool.request(method, url, data, headers, timeout=timeout, stream=stream)
+            if stream and status_code != HTTPStatus.OK:
+                body = body.read()
+        except (http_client.HTTPException, socket.error) as e:
+            return None, str(e), {}
+        return status_code, body, resp_headers
+
+    def _fetch(self, method, url, data, headers, timeout, stream=False):
         kwargs = {
-            'headers': self._headers(),
+            'headers': headers,
             'method': method,
-            'timeout': 1500
+            'timeout': timeout
         }
-        if payload:
-            kwargs['data'] = self.module.jsonify(payload)
+        if data:
+            kwargs['data'] = data
 
-        resp, info = fetch_url(self.module, url, **kwargs)
+        if isinstance(self.module, ControllerModule):
+            resp, info = self.module.fetch_url(url, **kwargs)
+        else:
+            resp, info = fetch_url(self.module, url, **kwargs)
         status_code = info.get('status', HTTPStatus.BAD_REQUEST)
-        body = info.get('body') if status_code >= HTTPStatus.BAD_REQUEST else resp.read()
-        return status_code, body
+        if status_code < 0:
+            return None, info.get('msg'), {}
+        if status_code >= HTTPStatus.BAD_REQUEST:
+            return status_code, info.get('body'), info
+        if stream and status_code == HTTPStatus.OK:
+            return status_code, StreamedResponse(resp, lambda complete: resp.close()), info
+        return status_code, resp.read(), info
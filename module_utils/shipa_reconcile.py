@@ -0,0 +1,379 @@
+import time
+
+from ansible.module_utils.shipa_client import (
+    app_cnames, cname_scheme, deep_merge, deploy_error, deploy_id, diff_output, env_delta, env_fingerprint, fingerprint,
+    normalize_network_policy, parse_duration, plan_diff, redact_write_only, resource_diff,
+)
+
+
+# Options of each resource, shared by its module and the matching section of the shipa_state document.
+# Application sub-resources leave out the app option, it is implied in the state document.
+
+def framework_spec():
+    return dict(
+        name=dict(type='str', required=True),
+        resources=dict(type='dict', required=False),
+        merge=dict(type='bool', default=False),
+        refresh=dict(type='bool', default=False),
+    )
+
+
+def cluster_spec():
+    return dict(
+        name=dict(type='str', required=True),
+        endpoint=dict(type='dict', required=True, no_log=True),
+        resources=dict(type='dict', required=True),
+        refresh=dict(type='bool', default=False),
+        force=dict(type='bool', default=False),
+    )
+
+
+def application_spec():
+    return dict(
+        name=dict(type='str', required=True),
+        framework=dict(type='str', required=True),
+        teamowner=dict(type='str', required=True),
+        plan=dict(type='str', required=True),
+        tags=dict(type='list', required=True),
+        refresh=dict(type='bool', default=False),
+    )
+
+
+def app_env_spec():
+    return dict(
+        envs=dict(type='list', elements='dict', required=False),
+        norestart=dict(type='bool', default=False),
+        private=dict(type='bool', default=False),
+        exclusive=dict(type='bool', default=False),
+    )
+
+
+def app_cname_spec():
+    return dict(
+        cname=dict(type='str', required=False),
+        encrypt=dict(type='bool', required=False),
+        cnames=dict(type='list', elements='dict', required=False, options=dict(
+            cname=dict(type='str', required=True),
+            encrypt=dict(type='bool', default=False),
+        )),
+        exclusive=dict(type='bool', default=False),
+    )
+
+
+APP_CNAME_CONSTRAINTS = dict(
+    mutually_exclusive=[('cname', 'cnames')],
+    required_one_of=[('cname', 'cnames')],
+    required_by={'cname': 'encrypt'},
+)
+
+
+def network_policy_spec():
+    return dict(
+        ingress=dict(type='dict', required=False),
+        egress=dict(type='dict', required=False),
+        restart_app=dict(type='bool', default=False),
+    )
+
+
+def app_deploy_spec():
+    return dict(
+        image=dict(type='str', required=True),
+
+        appConfig=dict(type='dict', required=False),
+        canarySettings=dict(type='dict', required=False),
+        podAutoScaler=dict(type='dict', required=False),
+        port=dict(type='dict', required=False),
+        registry=dict(type='dict', required=False),
+        volumes=dict(type='list', required=False),
+
+        force=dict(type='bool', default=False),
+        wait=dict(type='bool', default=True),
+        wait_timeout=dict(type='str', default='25m'),
+    )
+
+
+class ReconcileError(Exception):
+    """ Failure reconciling a resource, details are added to the module result """
+
+    def __init__(self, msg, **details):
+        super(ReconcileError, self).__init__(msg)
+        self.msg = msg
+        self.details = details
+
+
+def check(ok, resp):
+    if not ok:
+        raise ReconcileError(resp.message)
+    return resp
+
+
+class Context:
+    """ State shared by reconcile functions """
+
+    def __init__(self, shipa, check_mode=False):
+        self.shipa = shipa
+        self.check_mode = check_mode
+        # apps that do not exist yet, their sub-resources are planned without reading them in check mode
+        self.new_apps = set()
+        self.warnings = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+
+def run_reconcile(module, shipa, reconcile, *args):
+    """
+    Reconcile one resource for a module.
+
+    Warnings go to module.warn, a ReconcileError fails the module.
+
+    :return (changed, resource, details): see the reconcile functions
+    """
+    ctx = Context(shipa, module.check_mode)
+    try:
+        return reconcile(ctx, *args)
+    except ReconcileError as e:
+        module.fail_json(msg=e.msg, **e.details)
+    finally:
+        for warning in ctx.warnings:
+            module.warn(warning)
+
+
+# Reconcile functions bring a resource to its spec, options as in the *_spec functions above.
+# They return (changed, resource, details): the resource as the API returned it, or the planned one
+# in check mode, and details added to the module result, e.g. diff, an Ansible --diff view.
+
+def reconcile_framework(ctx, spec):
+    shipa = ctx.shipa
+    name, resources = spec['name'], spec.get('resources')
+    exists, resp = shipa.get_framework(name)
+    current_state = resp.json if exists else {}
+
+    if spec.get('merge') and exists:
+        current_resources = current_state.get('resources') or {}
+        resources = deep_merge(current_resources, resources or {})
+        if not resource_diff('framework', dict(resources=current_resources), dict(resources=resources)):
+            return False, current_state, dict(diff=diff_output({}))
+
+    if ctx.check_mode:
+        desired = shipa.prepare_framework_payload(name, resources)
+        changes = plan_diff('framework', current_state, desired, merge=False)
+        return not exists or bool(changes), current_state, dict(diff=diff_output(changes))
+
+    if exists:
+        resp = check(*shipa.update_framework(name, resources))
+    else:
+        resp = check(*shipa.create_framework(name, resources))
+
+    resource = None if spec.get('refresh') else shipa.written_resource(resp, name, ('shipaFramework', 'name'))
+    if resource is None:
+        resource = check(*shipa.get_framework(name)).json
+
+    changes = resource_diff('framework', current_state, resource)
+    return not exists or bool(changes), resource, dict(diff=diff_output(changes))
+
+
+def reconcile_cluster(ctx, spec):
+    shipa = ctx.shipa
+    name = spec['name']
+    payload = shipa.prepare_cluster_payload(name, spec.get('endpoint'), spec.get('resources'))
+
+    cluster_fingerprint = fingerprint(payload)
+    applied = shipa.get_fingerprint('cluster', name)
+    details = dict(fingerprint=cluster_fingerprint)
+    # secrets are not returned by the API, they can only be compared through the last applied fingerprint
+    credentials_changed = applied is not None and applied != cluster_fingerprint
+
+    exists, resp = shipa.get_cluster(name)
+    current_state = resp.json if exists else {}
+    changes = plan_diff('cluster', current_state, payload, merge=False)
+    details['diff'] = diff_output(changes)
+
+    if exists and not changes and applied == cluster_fingerprint and not spec.get('force'):
+        return False, redact_write_only('cluster', current_state), details
+    if ctx.check_mode:
+        return not exists or bool(changes) or credentials_changed, redact_write_only('cluster', current_state), details
+
+    if exists:
+        resp = check(*shipa.update_cluster(name, payload))
+    else:
+        resp = check(*shipa.create_cluster(payload))
+
+    resource = None if spec.get('refresh') else shipa.written_resource(resp, name)
+    if resource is None:
+        resource = check(*shipa.get_cluster(name)).json
+
+    shipa.set_fingerprint('cluster', name, cluster_fingerprint)
+
+    changes = resource_diff('cluster', current_state, resource)
+    details['diff'] = diff_output(changes)
+    return not exists or bool(changes) or credentials_changed, redact_write_only('cluster', resource), details
+
+
+def reconcile_application(ctx, spec):
+    shipa = ctx.shipa
+    name = spec['name']
+    app = {
+        'name': name,
+        'pool': spec.get('framework'),
+        'teamOwner': spec.get('teamowner'),
+        'plan': spec.get('plan'),
+        'tags': spec.get('tags'),
+    }
+    exists, resp = shipa.get_application(name)
+    current_state = resp.json if exists else {}
+
+    if ctx.check_mode:
+        if not exists:
+            ctx.new_apps.add(name)
+        changes = plan_diff('application', current_state, shipa.application_state(app))
+        return not exists or bool(changes), current_state, dict(diff=diff_output(changes))
+
+    if exists:
+        resp = check(*shipa.update_application(name, app))
+    else:
+        resp = check(*shipa.create_application(app))
+
+    resource = None if spec.get('refresh') else shipa.written_resource(resp, name)
+    if resource is None:
+        resource = check(*shipa.get_application(name)).json
+
+    changes = resource_diff('application', current_state, resource)
+    return not exists or bool(changes), resource, dict(diff=diff_output(changes))
+
+
+def reconcile_app_env(ctx, app, spec):
+    shipa = ctx.shipa
+    norestart, private = spec.get('norestart', False), spec.get('private', False)
+    current = [] if app in ctx.new_apps else check(*shipa.get_app_env(app)).json
+    # private values are masked by the API, they are compared with the fingerprints of the last applied ones
+    applied = {} if app in ctx.new_apps else shipa.get_fingerprint('app_env', app) or {}
+    delta = env_delta(current, spec.get('envs') or [], private, spec.get('exclusive', False), applied)
+    # values are left out as they might be private
+    details = dict(envs=dict(
+        added=[env.get('name') for env in delta['added']],
+        changed=[env.get('name') for env in delta['changed']],
+        removed=delta['removed'],
+    ))
+
+    resource = {}
+    updated = delta['added'] + delta['changed']
+    if updated and not ctx.check_mode:
+        # with a removal to follow, let the removal do the restart
+        payload = dict(app=app, envs=updated, norestart=norestart or bool(delta['removed']), private=private)
+        resource = check(*shipa.create_app_env(payload)).data
+        applied = dict(applied)
+        for env in updated:
+            if private:
+                applied[env.get('name')] = env_fingerprint(env)
+            else:
+                applied.pop(env.get('name'), None)
+        shipa.set_fingerprint('app_env', app, applied)
+    if delta['removed'] and not ctx.check_mode:
+        resource = check(*shipa.delete_app_env(app, delta['removed'], norestart)).data
+        shipa.set_fingerprint('app_env', app, dict(
+            (name, value) for name, value in applied.items() if name not in delta['removed']
+        ))
+
+    return any(delta.values()), resource, details
+
+
+def reconcile_app_cname(ctx, app, spec):
+    shipa = ctx.shipa
+    current = {} if app in ctx.new_apps else app_cnames(check(*shipa.get_application(app)).json)
+    desired = spec.get('cnames')
+    if desired is None:
+        desired = [dict(cname=spec['cname'], encrypt=spec.get('encrypt'))]
+
+    resource = {}
+    added = []
+    for item in desired:
+        encrypt = bool(item.get('encrypt'))
+        payload = dict(app=app, cname=item['cname'], encrypt=encrypt, scheme=cname_scheme(encrypt))
+        if current.get(payload['cname']) == payload['scheme']:
+            continue
+
+        added.append(payload['cname'])
+        if not ctx.check_mode:
+            resource = check(*shipa.create_app_cname(payload)).data
+
+    removed = []
+    if spec.get('cnames') is not None and spec.get('exclusive'):
+        names = set(item['cname'] for item in desired)
+        removed = sorted(cname for cname in current if cname not in names)
+        if removed and not ctx.check_mode:
+            check(*shipa.delete_app_cname(app, removed))
+
+    return bool(added or removed), resource, dict(cnames=dict(added=added, removed=removed))
+
+
+def reconcile_network_policy(ctx, app, spec):
+    shipa = ctx.shipa
+    payload = dict(app=app, ingress=spec.get('ingress'), egress=spec.get('egress'),
+                   restart_app=spec.get('restart_app', False))
+    diff = dict(before=normalize_network_policy({}), after=normalize_network_policy(payload))
+    if app in ctx.new_apps:
+        return True, {}, dict(diff=diff)
+
+    ok, resp = shipa.get_network_policy(app)
+    current = resp.json if ok else None
+    if ok and normalize_network_policy(current) == normalize_network_policy(payload):
+        return False, current, {}
+
+    if ok:
+        diff['before'] = normalize_network_policy(current)
+    if ctx.check_mode:
+        return True, current if ok else {}, dict(diff=diff)
+
+    check(*shipa.create_network_policy(payload))
+    return True, check(*shipa.get_network_policy(app)).json, dict(diff=diff)
+
+
+def reconcile_app_deploy(ctx, app, spec):
+    """ details hold the fingerprint, the finished deploy record and pending, set when the deploy was not waited for """
+    shipa = ctx.shipa
+    wait_timeout = spec.get('wait_timeout') or '25m'
+    try:
+        timeout = parse_duration(wait_timeout).total_seconds()
+    except AssertionError as e:
+        raise ReconcileError(str(e))
+    deadline = time.time() + timeout
+
+    req = shipa.prepare_deploy_request(dict(spec, app=app))
+    deploy_fingerprint = fingerprint(req)
+    details = dict(fingerprint=deploy_fingerprint, pending=False)
+    if not spec.get('force') and shipa.get_fingerprint('deploy', app) == deploy_fingerprint:
+        return False, {}, details
+    if ctx.check_mode:
+        return True, {}, details
+
+    wait = spec.get('wait', True)
+    previous_id = None
+    if wait:
+        ok, last = shipa.last_deploy(app)
+        if ok is None:
+            ctx.warn('the Shipa API does not report deploys, not waiting for the deploy of {}'.format(app))
+            wait = False
+        previous_id = deploy_id(last) if ok else None
+
+    ok, pending, resp = shipa.submit_deploy(req, timeout=max(1, deadline - time.time()))
+    if ok is None:
+        raise ReconcileError('timed out after {} waiting for deploy of {}'.format(wait_timeout, app), **details)
+    check(ok, resp)
+
+    if pending and wait:
+        ok, deploy = shipa.wait_for_deploy(app, previous_id, max(0, deadline - time.time()))
+        if ok is None:
+            ctx.warn('the Shipa API stopped reporting deploys, not waiting for the deploy of {}'.format(app))
+            wait = False
+        elif deploy is None:
+            raise ReconcileError('timed out after {} waiting for deploy of {}'.format(wait_timeout, app), **details)
+        elif not ok:
+            raise ReconcileError(deploy_error(app, deploy), deploy=deploy, **details)
+        else:
+            details['deploy'] = deploy
+
+    details['pending'] = pending and not wait
+    if not details['pending']:
+        shipa.set_fingerprint('deploy', app, deploy_fingerprint)
+    return True, resp.data, details
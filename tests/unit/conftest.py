@@ -0,0 +1,25 @@
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_module_utils(names=('shipa_client', 'shipa_reconcile')):
+    """ The shipa module_utils live next to the playbooks, not in the ansible package, load them by path """
+    for util in names:
+        name = 'ansible.module_utils.{}'.format(util)
+        if name not in sys.modules:
+            spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, 'module_utils', '{}.py'.format(util)))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules[name] = module
+
+
+try:
+    import ansible  # noqa: F401
+except ImportError:
+    # the tests skip themselves
+    pass
+else:
+    load_module_utils()
@@ -0,0 +1,152 @@
+import os
+import time
+import threading
+import importlib.util
+
+import pytest
+
+pytest.importorskip('ansible')
+
+from ansible.module_utils.shipa_reconcile import Context, ReconcileError  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+spec = importlib.util.spec_from_file_location('shipa_state', os.path.join(ROOT, 'library', 'shipa_state.py'))
+shipa_state = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(shipa_state)
+
+CONCURRENCY = dict((level, 4) for level in shipa_state.LEVELS)
+
+
+class StubClient:
+    def worker(self, fn):
+        return fn
+
+
+class Recorder:
+    """ Stub reconcile functions recording when each node started and finished """
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.events = []
+        self.running = dict((level, 0) for level in shipa_state.LEVELS)
+        self.peak = dict(self.running)
+        self._lock = threading.Lock()
+
+    def node(self, key, level='apps', error=None):
+        def reconcile():
+            with self._lock:
+                self.events.append(('start', key))
+                self.running[level] += 1
+                self.peak[level] = max(self.peak[level], self.running[level])
+            time.sleep(self.delay)
+            with self._lock:
+                self.events.append(('end', key))
+                self.running[level] -= 1
+            if error is not None:
+                raise error
+            return True, {'name': key}, {}
+        return reconcile
+
+    def index(self, event, key):
+        return self.events.index((event, key))
+
+
+def run(nodes, concurrency=None):
+    return shipa_state.run_graph(Context(StubClient(), False), nodes, concurrency or CONCURRENCY)
+
+
+def test_build_graph_dependencies():
+    state = dict(
+        frameworks=[dict(name='f')],
+        clusters=[dict(name='c', resources=dict(frameworks=[dict(name='f'), dict(name='external')]))],
+        apps=[
+            dict(name='a', framework='f', env=dict(envs=[]), cname=dict(cname='a.example.com'), deploy=dict(image='x')),
+            dict(name='b', framework='external'),
+        ],
+    )
+    nodes = shipa_state.build_graph(Context(StubClient(), False), state)
+    graph = dict((key, (level, sorted(deps))) for key, (level, deps, _) in nodes.items())
+    assert graph == {
+        'framework/f': ('frameworks', []),
+        'cluster/c': ('clusters', ['framework/f']),
+        'app/a': ('apps', ['cluster/c', 'framework/f']),
+        'app/a/env': ('app_resources', ['app/a']),
+        'app/a/cname': ('app_resources', ['app/a']),
+        'app/a/deploy': ('deploys', ['app/a', 'app/a/cname', 'app/a/env']),
+        'app/b': ('apps', ['cluster/c']),
+    }
+
+
+def test_run_graph_runs_dependencies_first():
+    recorder = Recorder()
+    nodes = {
+        'framework/f': ('frameworks', [], recorder.node('framework/f', 'frameworks')),
+        'cluster/c': ('clusters', ['framework/f'], recorder.node('cluster/c', 'clusters')),
+        'app/a': ('apps', ['cluster/c', 'framework/f'], recorder.node('app/a')),
+        'app/a/env': ('app_resources', ['app/a'], recorder.node('app/a/env', 'app_resources')),
+        'app/a/deploy': ('deploys', ['app/a', 'app/a/env'], recorder.node('app/a/deploy', 'deploys')),
+        # dependencies outside the document are ignored
+        'app/b': ('apps', ['framework/missing'], recorder.node('app/b')),
+    }
+    reports = run(nodes)
+
+    assert all(report['status'] == 'SUCCESS' and report['changed'] for report in reports.values())
+    assert reports['app/a']['result'] == {'name': 'app/a'}
+    for key, (_, deps, _) in nodes.items():
+        for dep in deps:
+            if dep in nodes:
+                assert recorder.index('end', dep) < recorder.index('start', key)
+
+
+def test_run_graph_skips_dependents_of_failures():
+    recorder = Recorder(delay=0)
+    nodes = {
+        'framework/f': ('frameworks', [], recorder.node('framework/f', 'frameworks',
+                                                        ReconcileError('boom', diff={'plan': 1}))),
+        'cluster/c': ('clusters', ['framework/f'], recorder.node('cluster/c', 'clusters')),
+        'app/a': ('apps', ['cluster/c'], recorder.node('app/a')),
+        'app/b': ('apps', [], recorder.node('app/b', error=KeyError('name'))),
+        'app/b/env': ('app_resources', ['app/b'], recorder.node('app/b/env', 'app_resources')),
+        'app/c': ('apps', [], recorder.node('app/c')),
+    }
+    reports = run(nodes)
+
+    assert reports['framework/f']['status'] == 'FAILED'
+    assert reports['framework/f']['msg'] == 'boom'
+    assert reports['framework/f']['diff'] == {'plan': 1}
+    assert reports['app/b']['status'] == 'FAILED'
+    assert reports['app/b']['msg'] == "KeyError: 'name'"
+    assert 'Traceback' in reports['app/b']['exception']
+    for key in ('cluster/c', 'app/a', 'app/b/env'):
+        assert reports[key] == dict(status='SKIPPED', changed=False, msg='dependency failed')
+        assert ('start', key) not in recorder.events
+    assert reports['app/c']['status'] == 'SUCCESS'
+
+
+def test_run_graph_bounds_concurrency_per_level():
+    recorder = Recorder(delay=0.05)
+    nodes = dict(('app/{}'.format(i), ('apps', [], recorder.node('app/{}'.format(i)))) for i in range(6))
+    nodes.update(('app/{}/env'.format(i), ('app_resources', ['app/{}'.format(i)],
+                                           recorder.node('app/{}/env'.format(i), 'app_resources'))) for i in range(6))
+    reports = run(nodes, dict(CONCURRENCY, apps=2, app_resources=3))
+
+    assert all(report['status'] == 'SUCCESS' for report in reports.values())
+    assert recorder.peak['apps'] == 2
+    assert 1 <= recorder.peak['app_resources'] <= 3
+
+
+def test_run_graph_reports_cycles():
+    recorder = Recorder(delay=0)
+    nodes = {
+        'app/a': ('apps', ['app/b'], recorder.node('app/a')),
+        'app/b': ('apps', ['app/a'], recorder.node('app/b')),
+        'app/c': ('apps', [], recorder.node('app/c')),
+        'app/c/env': ('app_resources', ['app/c', 'app/a'], recorder.node('app/c/env', 'app_resources')),
+    }
+    reports = run(nodes)
+
+    assert reports['app/c']['status'] == 'SUCCESS'
+    for key in ('app/a', 'app/b', 'app/c/env'):
+        assert reports[key] == dict(status='SKIPPED', changed=False, msg='dependency cycle')
+    assert recorder.events == [('start', 'app/c'), ('end', 'app/c')]
@@ -0,0 +1,171 @@
+import json
+
+import pytest
+
+pytest.importorskip('ansible')
+
+from ansible.module_utils.shipa_client import (  # noqa: E402
+    Response, env_delta, env_fingerprint, iter_json_list, job_status, normalize_network_policy, plan_diff,
+    redact_write_only, resource_diff,
+)
+
+
+def chunked(document, size):
+    data = document.encode('utf-8')
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('document', [
+    '',
+    'null',
+    ' null\n',
+    '[]',
+    '[1.5]',
+    '[1.5e-3, -2, 3E+2, 10]',
+    '[true, false, null]',
+    '[{"name": "a", "tags": ["x]", "y,"]}, "été", {"n": {"m": []}}]',
+])
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64 * 1024])
+def test_iter_json_list_any_chunking(document, size):
+    expected = json.loads(document) if document.strip() else None
+    assert list(iter_json_list(chunked(document, size))) == (expected or [])
+
+
+@pytest.mark.parametrize('document', ['{}', '[1 2]', '[1,]', '[1', '[1.x]', 'nul'])
+@pytest.mark.parametrize('size', [1, 64 * 1024])
+def test_iter_json_list_invalid(document, size):
+    with pytest.raises(ValueError):
+        list(iter_json_list(chunked(document, size)))
+
+
+def test_iter_json_list_stops_reading():
+    read = []
+
+    def chunks():
+        for chunk in (b'[1, ', b'2, ', b'3]'):
+            read.append(chunk)
+            yield chunk
+
+    items = iter_json_list(chunks())
+    assert next(items) == 1
+    assert read == [b'[1, ']
+
+
+def test_env_delta():
+    current = [
+        dict(name='SAME', value='1', public=True),
+        dict(name='CHANGED', value='1', public=True),
+        dict(name='PRIVATE', value='*** (private variable)', public=False),
+        dict(name='EXTRA', value='1', public=True),
+        dict(name='SHIPA_APPNAME', value='app', public=True),
+    ]
+    desired = [
+        dict(name='SAME', value=1),
+        dict(name='CHANGED', value='2'),
+        dict(name='PRIVATE', value='secret'),
+        dict(name='NEW', value='1'),
+    ]
+
+    delta = env_delta(current, desired, exclusive=True)
+    assert [env['name'] for env in delta['added']] == ['NEW']
+    assert [env['name'] for env in delta['changed']] == ['CHANGED', 'PRIVATE']
+    assert delta['removed'] == ['EXTRA']
+
+    assert env_delta(current, desired)['removed'] == []
+    assert len(env_delta(current, desired, private=True)['changed']) == 3
+
+
+def test_env_delta_private_fingerprints():
+    current = [dict(name='TOKEN', value='*** (private variable)', public=False)]
+    applied = dict(TOKEN=env_fingerprint(dict(name='TOKEN', value='secret')))
+
+    assert env_delta(current, [dict(name='TOKEN', value='secret')], private=True, applied=applied)['changed'] == []
+    assert env_delta(current, [dict(name='TOKEN', value='other')], private=True, applied=applied)['changed']
+    # made public again
+    assert env_delta(current, [dict(name='TOKEN', value='secret')], applied=applied)['changed']
+    # public envs are made private even when their value is unchanged
+    public = [dict(name='TOKEN', value='secret', public=True)]
+    assert env_delta(public, [dict(name='TOKEN', value='secret')], private=True, applied=applied)['changed']
+
+
+def test_resource_diff_rules():
+    before = dict(name='app', tags=['a', 'b'], createdAt='yesterday', description='')
+    after = dict(name='app', tags=['b', 'a'], createdAt='today')
+    assert resource_diff('application', before, after) == {}
+
+    changes = resource_diff('application', dict(plan=dict(name='small')), dict(plan=dict(name='large')))
+    assert changes == {'plan.name': dict(before='small', after='large')}
+
+
+def test_resource_diff_defaults_without_parents():
+    default = dict(resources=dict(general=dict(setup=dict(provisioner='kubernetes'))))
+    assert resource_diff('framework', dict(resources=dict(general={})), default) == {}
+    assert resource_diff('framework', {}, default) == {}
+    assert resource_diff('framework', dict(resources=dict(general=dict(setup=dict(provisioner='other')))), default)
+
+
+def test_plan_diff_write_only():
+    current = dict(endpoint=dict(addresses=['https://a'], token='server', caCert='server'))
+    desired = dict(endpoint=dict(addresses=['https://a'], token='secret'))
+    assert plan_diff('cluster', current, desired, merge=False) == {}
+    assert plan_diff('cluster', {}, desired, merge=False) == {
+        'endpoint': dict(before=None, after=dict(addresses=['https://a'])),
+    }
+
+
+def test_redact_write_only():
+    state = dict(endpoint=dict(addresses=['https://a'], token='secret', caCert=''))
+    assert redact_write_only('cluster', state) == dict(endpoint=dict(addresses=['https://a'], token='<redacted>',
+                                                                     caCert=''))
+    assert state['endpoint']['token'] == 'secret'
+
+
+def test_normalize_network_policy():
+    policy = dict(
+        ingress=dict(custom_rules=[
+            dict(id='b', ports=[dict(port=80)]),
+            dict(id='a', ports=[dict(port=443, protocol='TCP')], allowed_apps=[]),
+        ]),
+    )
+    reordered = dict(
+        ingress=dict(policy_mode='allow-all', custom_rules=[
+            dict(id='a', ports=[dict(port=443)]),
+            dict(id='b', ports=[dict(port=80, protocol='TCP')]),
+        ]),
+        egress=None,
+    )
+    assert normalize_network_policy(policy) == normalize_network_policy(reordered)
+    assert normalize_network_policy(None) == normalize_network_policy(dict(egress=dict(policy_mode='allow-all')))
+    assert normalize_network_policy(policy) != normalize_network_policy(dict(ingress=dict(policy_mode='deny-all')))
+
+
+@pytest.mark.parametrize('job, expected', [
+    (dict(status=dict(conditions=[dict(type='Complete', status='True')])), (True, True)),
+    (dict(status=dict(conditions=[dict(type='Failed', status='True')])), (True, False)),
+    (dict(status=dict(conditions=[dict(type='Complete', status='False')], active=1)), (False, False)),
+    (dict(status='failed'), (True, False)),
+    (dict(status='Succeeded'), (True, True)),
+    (dict(completions=2, status=dict(succeeded=2)), (True, True)),
+    (dict(completions=2, succeeded=1, active=1), (False, False)),
+    (dict(backoffLimit=1, failed=2), (True, False)),
+    (dict(backoffLimit=1, failed=1), (False, False)),
+    (dict(), (False, False)),
+])
+def test_job_status(job, expected):
+    assert job_status(job) == expected
+
+
+@pytest.mark.parametrize('status, body, error', [
+    (200, b'{"name": "app"}', None),
+    (200, b'{"name": "error", "tags": ["error"]}', None),
+    (200, b'{"Error": "quota exceeded"}', 'quota exceeded'),
+    (201, b'{"error": {"message": "bad image"}}', 'bad image'),
+    (200, b'{"Message": "building"}\n{"Error": "build failed"}\n', 'build failed'),
+    (404, b'{"Error": "app not found"}', 'app not found'),
+    (500, b'internal error', 'internal error'),
+    (502, b'', 'shipa API returned 502'),
+])
+def test_response_error(status, body, error):
+    resp = Response(status, body)
+    assert resp.error == error
+    assert resp.message == (error or body.decode('utf-8'))
@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+import importlib.util
+
+import pytest
+
+pytest.importorskip('ansible')
+
+from ansible.module_utils import shipa_client  # noqa: E402
+from ansible.module_utils.shipa_client import ConnectionPool, ControllerModule, ShipaError  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+spec = importlib.util.spec_from_file_location('shipa_stub', os.path.join(ROOT, 'benchmarks', 'stub.py'))
+stub = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(stub)
+
+
+@pytest.fixture
+def server():
+    server = stub.StubServer(('127.0.0.1', 0), size=3)
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def pools():
+    """ Every test starts without kept-alive connections, as a new task would """
+    yield
+    for pool in ConnectionPool._shared.values():
+        pool.close()
+    ConnectionPool._shared.clear()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """ Backoff delays the client waited, without waiting for them """
+    delays = []
+    monkeypatch.setattr(shipa_client.time, 'sleep', delays.append)
+    return delays
+
+
+@pytest.fixture
+def client(server, tmp_path):
+    def make(**params):
+        params = dict(dict(shipa_cache_dir=str(tmp_path)), **params)
+        host = 'http://{}:{}'.format(*server.server_address)
+        return shipa_client.Client(ControllerModule(params), host, 'token')
+    return make
+
+
+def requests(server, endpoint):
+    return server.stats()['endpoints'].get(endpoint, 0)
+
+
+def test_keepalive_reuses_connection(server, client):
+    shipa = client()
+    for _ in range(3):
+        ok, resp = shipa.get_application('app-0')
+        assert ok and resp.json['name'] == 'app-0'
+    assert server.stats()['connections'] == 1
+
+
+def test_retries_idempotent_failures(server, client, sleeps):
+    server.add_faults([dict(status=503), dict(status=502)])
+    ok, resp = client().get_application('app-0')
+
+    assert ok
+    assert requests(server, 'GET apps/{name}') == 3
+    assert len(sleeps) == 2
+
+
+def test_retries_give_up(server, client, sleeps):
+    server.add_faults([dict(status=503)] * 5)
+    ok, resp = client(shipa_retries=2).get_application('app-0')
+
+    assert not ok and resp.status == 503
+    assert requests(server, 'GET apps/{name}') == 3
+
+
+def test_retry_after(server, client, sleeps):
+    server.add_faults([dict(status=503, headers={'Retry-After': '7'})])
+    ok, _ = client().get_application('app-0')
+
+    assert ok
+    assert sleeps == [7.0]
+
+
+def test_post_not_retried_on_server_errors(server, client, sleeps):
+    server.add_faults([dict(status=503)])
+    ok, resp = client().create_job(dict(name='job-new'))
+
+    assert not ok and resp.status == 503
+    assert requests(server, 'POST jobs') == 1
+    assert sleeps == []
+
+
+def test_post_retried_when_throttled(server, client, sleeps):
+    server.add_faults([dict(status=429, headers={'Retry-After': '1'})])
+    ok, _ = client().create_job(dict(name='job-new'))
+
+    assert ok
+    assert requests(server, 'POST jobs') == 2
+    assert sleeps == [1.0]
+
+
+def test_breaker_counts_requests_once(server, client, sleeps):
+    # every attempt of the first request fails, the circuit stays closed
+    server.add_faults([dict(status=503)] * 4)
+    shipa = client(shipa_circuit_threshold=2)
+    assert not shipa.get_application('app-0')[0]
+    assert shipa.get_application('app-0')[0]
+
+
+def test_breaker_opens_and_fails_fast(server, client, sleeps):
+    server.add_faults([dict(status=503)] * 2)
+    shipa = client(shipa_retries=0, shipa_circuit_threshold=2)
+    assert not shipa.get_application('app-0')[0]
+    assert not shipa.get_application('app-0')[0]
+
+    with pytest.raises(ShipaError, match='is failing'):
+        shipa.get_application('app-0')
+    assert requests(server, 'GET apps/{name}') == 2
+
+
+def test_breaker_closes_on_success(server, client, sleeps):
+    server.add_faults([dict(status=503), dict(status=429), {}, dict(status=503)])
+    shipa = client(shipa_retries=0, shipa_circuit_threshold=2)
+    assert not shipa.get_application('app-0')[0]
+    # throttling is not counted
+    assert not shipa.get_application('app-0')[0]
+    # a success resets the count
+    assert shipa.get_application('app-0')[0]
+    assert not shipa.get_application('app-0')[0]
+    assert shipa.get_application('app-0')[0]
+
+
+def test_stale_connection_resends_idempotent_request(server, client, sleeps):
+    shipa = client()
+    assert shipa.get_application('app-0')[0]
+    server.add_faults([dict(drop=True)])
+
+    assert shipa.get_application('app-0')[0]
+    assert requests(server, 'GET apps/{name}') == 3
+    assert server.stats()['connections'] == 2
+    # resent at once on a new connection, not through the retry backoff
+    assert sleeps == []
+
+
+def test_stale_connection_does_not_resend_post(server, client, sleeps):
+    shipa = client()
+    assert shipa.get_application('app-0')[0]
+    server.add_faults([dict(drop=True)])
+
+    with pytest.raises(ShipaError, match='POST'):
+        shipa.create_job(dict(name='job-new'))
+    assert requests(server, 'POST jobs') == 1
+
+
+def test_post_skips_connection_closed_while_idle(server, client):
+    shipa = client()
+    server.add_faults([dict(close=True)])
+    assert shipa.get_application('app-0')[0]
+    # let the close reach the client
+    time.sleep(0.1)
+
+    assert shipa.create_job(dict(name='job-new'))[0]
+    assert requests(server, 'POST jobs') == 1
+    assert server.stats()['connections'] == 2